@@ -0,0 +1,373 @@
+"""Offline benchmarks for the robot pipelines.
+
+Run from the rpi directory, e.g. ``python bench.py telemetry``. Nothing here
+needs the Pi hardware or the relay server.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+import robot
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server")
+
+# name, rate_hz, channels, scale, noise
+SIM_SENSORS = [
+    ("imu", 50, 6, 0.001, 0.05),
+    ("motor_current", 50, 2, 0.001, 0.02),
+    ("gas", 20, 1, 0.1, 0.5),
+    ("temperature", 10, 1, 0.01, 0.02),
+]
+
+
+def _load_server():
+    # Relay fan-out is only timed when the server deps are importable.
+    sys.path.insert(0, SERVER_DIR)
+    try:
+        import app
+    except Exception as e:
+        print(f"relay not timed ({e})")
+        return None
+    finally:
+        sys.path.pop(0)
+    return app
+
+
+def _simulate_samples(duration_s, seed=0):
+    rng = np.random.default_rng(seed)
+    start = time.time()
+    samples = []
+    for name, rate_hz, channels, _, noise in SIM_SENSORS:
+        count = int(duration_s * rate_hz)
+        ts = start + np.arange(count) / rate_hz
+        values = 20 + np.cumsum(rng.normal(0, noise, (count, channels)), axis=0)
+        for i in range(count):
+            samples.append((ts[i], name, values[i]))
+    samples.sort(key=lambda sample: sample[0])
+    return samples
+
+
+def _bench_json(samples):
+    messages = []
+    started = time.process_time()
+    for ts, name, value in samples:
+        payload = {
+            "uuid": robot.ROBOT_UUID,
+            "sensor": name,
+            "values": [float(v) for v in value],
+            "ts": int(ts * 1000),
+        }
+        messages.append(json.dumps(payload))
+    cpu = time.process_time() - started
+    return messages, cpu
+
+
+def _bench_binary(samples):
+    sensors = {}
+    for name, rate_hz, channels, scale, _ in SIM_SENSORS:
+        sensors[name] = robot._register_sensor(
+            name, rate_hz, lambda: None, channels=channels, scale=scale
+        )
+    packets = []
+    interval = 1.0 / robot.TELEMETRY_BATCH_HZ
+    next_flush = samples[0][0] + interval
+    started = time.process_time()
+    for ts, name, value in samples:
+        if ts >= next_flush:
+            packets.append(robot._encode_telemetry_batch(robot._drain_sensors()))
+            next_flush += interval
+        robot._record_sample(sensors[name], ts, value)
+    batches = robot._drain_sensors()
+    if batches:
+        packets.append(robot._encode_telemetry_batch(batches))
+    cpu = time.process_time() - started
+    with robot._sensors_lock:
+        robot._sensors[:] = [s for s in robot._sensors if s not in sensors.values()]
+    return packets, cpu
+
+
+def bench_telemetry(args):
+    samples = _simulate_samples(args.duration)
+    json_messages, json_cpu = _bench_json(samples)
+    packets, binary_cpu = _bench_binary(samples)
+    server = _load_server()
+
+    rows = [
+        ("json per message", json_messages, json_cpu),
+        ("binary batched", packets, binary_cpu),
+    ]
+    print(
+        f"{len(samples)} samples over {args.duration}s "
+        f"({len(samples) / args.duration:.0f} samples/s)"
+    )
+    print(f"{'mode':<18}{'msgs/s':>10}{'bytes/s':>12}{'robot cpu %':>14}{'relay cpu %':>14}")
+    for label, messages, cpu in rows:
+        relay = "--"
+        if server is not None:
+            relay = f"{100 * _relay_cpu(server, messages) / args.duration:.3f}"
+        total_bytes = sum(len(message) for message in messages)
+        print(
+            f"{label:<18}{len(messages) / args.duration:>10.1f}"
+            f"{total_bytes / args.duration:>12.0f}"
+            f"{100 * cpu / args.duration:>14.3f}{relay:>14}"
+        )
+
+
+class _NullClient:
+    def send(self, data, *args, **kwargs):
+        pass
+
+
+def _relay_cpu(server, messages):
+    # One JSON viewer attached, so binary packets pay the decode as well.
+    robot_id = "bench"
+    server.telemetry_clients[robot_id] = {_NullClient(): "json"}
+    started = time.process_time()
+    for message in messages:
+        server._broadcast_telemetry(robot_id, message)
+    cpu = time.process_time() - started
+    server.telemetry_clients.pop(robot_id, None)
+    return cpu
+
+
+def _legacy_thermal_to_image(temp):
+    # The pre-LUT render path, kept here as the comparison baseline.
+    temp = np.clip(temp, robot.TEMP_MIN, robot.TEMP_MAX)
+    norm = (temp - robot.TEMP_MIN) / (robot.TEMP_MAX - robot.TEMP_MIN)
+    img = (norm * 255).astype(np.uint8)
+    img = cv2.applyColorMap(img, cv2.COLORMAP_JET)
+    return cv2.resize(
+        img,
+        (robot.THERMAL_FRAME_WIDTH, robot.THERMAL_FRAME_HEIGHT),
+        interpolation=cv2.INTER_CUBIC,
+    )
+
+
+def _time_render(render, frames):
+    tracemalloc.start()
+    started = time.perf_counter()
+    for temp in frames:
+        render(temp)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed / len(frames), peak
+
+
+def bench_thermal(args):
+    source = robot._SimulatedMLX(refresh_hz=1e6)
+    flat = np.zeros(robot.THERMAL_SHAPE[0] * robot.THERMAL_SHAPE[1], dtype=np.float32)
+    frames = []
+    for _ in range(args.frames):
+        source.getFrame(flat)
+        frames.append(flat.reshape(robot.THERMAL_SHAPE).copy())
+
+    buffers = robot._thermal_render_buffers()
+    legacy_s, legacy_peak = _time_render(_legacy_thermal_to_image, frames)
+    lut_s, lut_peak = _time_render(
+        lambda temp: robot._thermal_to_image(temp, buffers), frames
+    )
+    stats_s, _ = _time_render(robot._thermal_frame_stats, frames)
+
+    print(f"{args.frames} simulated {robot.THERMAL_SHAPE[1]}x{robot.THERMAL_SHAPE[0]} frames")
+    print(f"{'render':<12}{'ms/frame':>10}{'peak alloc B':>14}")
+    print(f"{'legacy':<12}{legacy_s * 1000:>10.3f}{legacy_peak:>14}")
+    print(f"{'lut':<12}{lut_s * 1000:>10.3f}{lut_peak:>14}")
+    print(f"stats from the same frame: {stats_s * 1000:.3f} ms/frame")
+    # The old sender read the sensor once per streamed frame and again for
+    # every telemetry sample; the reader thread now reads once per refresh.
+    print(
+        f"sensor reads/s: legacy {robot.THERMAL_FPS + 1}, "
+        f"reader {robot.THERMAL_REFRESH_HZ}"
+    )
+
+
+class _MockGPIO:
+    """Accepts the RPi.GPIO calls the motor code makes and does nothing."""
+
+    BCM = "BCM"
+    OUT = "OUT"
+    LOW = 0
+    HIGH = 1
+
+    class PWM:
+        def __init__(self, pin, frequency):
+            pass
+
+        def start(self, duty):
+            pass
+
+        def ChangeDutyCycle(self, duty):
+            pass
+
+    def setmode(self, mode):
+        pass
+
+    def setup(self, pin, mode):
+        pass
+
+    def output(self, pin, value):
+        pass
+
+
+class _SyntheticCapture:
+    """cv2.VideoCapture stand-in paced like a camera.
+
+    Frames come from a video file (looped and resized) when one is given,
+    otherwise a moving gradient with sensor-like noise is generated.
+    """
+
+    def __init__(self, width, height, fps, video_path=None):
+        self.width = width
+        self.height = height
+        self.period = 1.0 / fps
+        self.next_frame = time.monotonic()
+        self.source = cv2.VideoCapture(video_path) if video_path else None
+        self.rng = np.random.default_rng(0)
+        ramp = np.linspace(0, 255, width, dtype=np.float32)
+        self.base = np.tile(ramp, (height, 1))
+        self.tick = 0
+
+    def isOpened(self):
+        return self.source is None or self.source.isOpened()
+
+    def read(self):
+        now = time.monotonic()
+        if now < self.next_frame:
+            time.sleep(self.next_frame - now)
+        self.next_frame = max(self.next_frame + self.period, time.monotonic())
+        self.tick += 1
+        if self.source is not None:
+            ok, frame = self.source.read()
+            if not ok:
+                self.source.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                ok, frame = self.source.read()
+            if not ok:
+                return False, None
+            return True, cv2.resize(frame, (self.width, self.height))
+        shifted = np.roll(self.base, self.tick * 4, axis=1)
+        noise = self.rng.normal(0, 6, (self.height, self.width))
+        gray = np.clip(shifted + noise, 0, 255).astype(np.uint8)
+        return True, cv2.merge([gray, np.flipud(gray), gray[:, ::-1]])
+
+    def release(self):
+        if self.source is not None:
+            self.source.release()
+
+
+def _start_local_relay():
+    from werkzeug.serving import make_server
+
+    server = _load_server()
+    if server is None:
+        raise SystemExit("no --relay given and the local relay cannot start")
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    httpd = make_server("127.0.0.1", 0, server.app, threaded=True)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return f"ws://127.0.0.1:{httpd.server_port}", httpd
+
+
+def _run_pipeline(ws_base, width, height, quality, args):
+    robot._latest_usb_frame = None
+    cap = _SyntheticCapture(width, height, args.camera_fps, args.video)
+    stats = {}
+    stop = threading.Event()
+    workers = [
+        threading.Thread(target=robot._capture_latest_frames, args=(cap, stats, stop)),
+        threading.Thread(
+            target=robot._video_sender,
+            args=(f"{ws_base}/ws/video/robot/bench", args.fps, quality, stats, stop),
+        ),
+    ]
+    for worker in workers:
+        worker.start()
+    time.sleep(args.duration)
+    stop.set()
+    for worker in workers:
+        worker.join()
+    cap.release()
+    return stats
+
+
+def bench_pipeline(args):
+    robot.GPIO = _MockGPIO()
+    robot._setup_gpio()
+    httpd = None
+    ws_base = args.relay
+    if ws_base is None:
+        ws_base, httpd = _start_local_relay()
+    resolutions = [tuple(int(v) for v in res.split("x")) for res in args.resolutions]
+    stages = ("capture", "copy", "encode", "send")
+    header = f"{'resolution':<12}{'q':>4}{'fps':>7}{'bytes/frame':>13}"
+    header += "".join(f"{stage + ' ms':>12}{'cpu %':>7}" for stage in stages)
+    print(f"relay {ws_base}, target {args.fps} fps, {args.duration}s per run")
+    # Capture wall time includes waiting for the next camera frame, and its
+    # CPU is the synthetic source's, so compare it across runs only.
+    print(header)
+    try:
+        for width, height in resolutions:
+            for quality in args.qualities:
+                stats = _run_pipeline(ws_base, width, height, quality, args)
+                sent = stats.get("send", {"count": 0, "bytes": 0})
+                row = f"{f'{width}x{height}':<12}{quality:>4}"
+                row += f"{sent['count'] / args.duration:>7.1f}"
+                row += f"{sent['bytes'] / max(1, sent['count']):>13.0f}"
+                for stage in stages:
+                    entry = stats.get(stage)
+                    if not entry:
+                        row += f"{'--':>12}{'--':>7}"
+                        continue
+                    row += f"{1000 * entry['wall'] / entry['count']:>12.2f}"
+                    row += f"{100 * entry['cpu'] / args.duration:>7.1f}"
+                print(row)
+    finally:
+        if httpd is not None:
+            httpd.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    telemetry = commands.add_parser(
+        "telemetry", help="binary batched telemetry vs JSON per message"
+    )
+    telemetry.add_argument("--duration", type=float, default=60.0)
+    telemetry.set_defaults(func=bench_telemetry)
+
+    thermal = commands.add_parser(
+        "thermal", help="LUT thermal render vs the per-frame colormap path"
+    )
+    thermal.add_argument("--frames", type=int, default=2000)
+    thermal.set_defaults(func=bench_thermal)
+
+    pipeline = commands.add_parser(
+        "pipeline", help="capture/copy/encode/send over resolutions and JPEG qualities"
+    )
+    pipeline.add_argument(
+        "--relay", help="relay ws base URL, e.g. ws://127.0.0.1:5000 (default: in-process)"
+    )
+    pipeline.add_argument("--video", help="video file to replay instead of generated frames")
+    pipeline.add_argument(
+        "--resolutions", nargs="+", default=["320x180", "480x270", "640x360", "1280x720"]
+    )
+    pipeline.add_argument("--qualities", nargs="+", type=int, default=[30, 50, 70, 90])
+    pipeline.add_argument("--fps", type=float, default=robot.TARGET_FPS)
+    pipeline.add_argument("--camera-fps", type=float, default=30.0)
+    pipeline.add_argument("--duration", type=float, default=5.0)
+    pipeline.set_defaults(func=bench_pipeline)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,34 @@
 import json
+import os
+import struct
 import threading
 import time
 import urllib.request
+from collections import deque
 
 import cv2
 import numpy as np
 
-# --- THERMAL INTEGRATION DISABLED ---
-# import board
-# import busio
-# import adafruit_mlx90640
-
-from websocket import create_connection, WebSocketTimeoutException
+from websocket import (
+    create_connection,
+    WebSocketBadStatusException,
+    WebSocketTimeoutException,
+)
 
 try:
     import RPi.GPIO as GPIO
 except Exception:
     GPIO = None
 
-SERVER_BASE = "wss://detectionbot12-colo.onrender.com"
-SERVER_HTTP = "https://detectionbot12-colo.onrender.com"
+try:
+    import board
+    import busio
+    import adafruit_mlx90640
+except Exception:
+    adafruit_mlx90640 = None
+
+SERVER_HTTP = os.environ.get("ROBOT_SERVER_HTTP", "https://detectionbot12-colo.onrender.com")
+SERVER_BASE = SERVER_HTTP.replace("https://", "wss://", 1).replace("http://", "ws://", 1)
 ROBOT_UUID = "Agraid"
 ROBOT_TYPE = "rpi-rover"
 WARMUP_URL = SERVER_HTTP
@@ -32,21 +41,42 @@ FRAME_HEIGHT = 270
 JPEG_QUALITY = 50
 MAX_FRAME_DROP = 5
 
+TRACE_SAMPLE_EVERY = 10
+UNCHANGED_MESSAGE = json.dumps({"type": "unchanged"})
+CLOCK_SYNC_INTERVAL_S = 5
+CLOCK_SYNC_SAMPLES = 8
+
 USB_CAM_INDEX = 0
 USB_CAM_CANDIDATES = [USB_CAM_INDEX, 1, 2, 3]
+USB_CAM_FORMATS = ["MJPG", "YUYV"]
+CAMERA_CACHE_PATH = os.environ.get(
+    "CAMERA_CACHE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".camera_cache.json"),
+)
 
-# --- THERMAL SETTINGS DISABLED ---
-# THERMAL_FPS = 8
-# THERMAL_FRAME_WIDTH = 320
-# THERMAL_FRAME_HEIGHT = 240
-# THERMAL_JPEG_QUALITY = 70
-# TEMP_MIN = 20.0
-# TEMP_MAX = 40.0
+THERMAL_FPS = 8
+THERMAL_REFRESH_HZ = 2
+THERMAL_FRAME_WIDTH = 320
+THERMAL_FRAME_HEIGHT = 240
+THERMAL_JPEG_QUALITY = 70
+THERMAL_SHAPE = (24, 32)
+THERMAL_SOURCE = os.environ.get("THERMAL_SOURCE", "mlx")  # "mlx" or "sim"
+TEMP_MIN = 20.0
+TEMP_MAX = 40.0
 
 VIDEO_URL = f"{SERVER_BASE}/ws/video/robot/{ROBOT_UUID}"
-# THERMAL_URL = f"{SERVER_BASE}/ws/thermal/robot/{ROBOT_UUID}"
+THERMAL_URL = f"{SERVER_BASE}/ws/thermal/robot/{ROBOT_UUID}"
 COMMAND_URL = f"{SERVER_BASE}/ws/command/robot/{ROBOT_UUID}"
-# TELEMETRY_URL = f"{SERVER_BASE}/ws/telemetry/robot/{ROBOT_UUID}"
+TELEMETRY_URL = f"{SERVER_BASE}/ws/telemetry/robot/{ROBOT_UUID}"
+
+TELEMETRY_BATCH_HZ = 4
+TELEMETRY_BUFFER_S = 2
+TELEMETRY_MAGIC = b"LT"
+TELEMETRY_VERSION = 2
+# Packet: header, then per sensor a name, block header, uint16 ms timestamp
+# deltas and int16/int32 quantized value deltas (row-major, samples x channels).
+TELEMETRY_HEADER = struct.Struct("<2sBBQ")
+TELEMETRY_BLOCK = struct.Struct("<BHBd")
 
 MOTOR_PINS = {
     "motor1Pin1": 17,  # IN1
@@ -64,19 +94,58 @@ _current_speed = 100
 _pwm_a = None
 _pwm_b = None
 
-# --- THERMAL STATE DISABLED ---
-# _mlx_lock = threading.Lock()
-# _mlx = None
+_mlx = None
+# Double buffer: the reader fills the back frame, then swaps it to the front
+# together with stats computed from that same frame.
+_thermal_frames = [np.zeros(THERMAL_SHAPE, dtype=np.float32) for _ in range(2)]
+_thermal_front = 0
+_thermal_seq = 0
+_thermal_stats = None
+_thermal_lock = threading.Lock()
 
 _latest_usb_frame = None
+_latest_usb_frame_ts = 0.0
+_latest_usb_frame_id = 0
 _latest_usb_lock = threading.Lock()
 
+# (rtt, offset) pairs from clock_sync round trips over the command socket;
+# the lowest-RTT sample gives the best server clock offset estimate.
+_clock_samples = deque(maxlen=CLOCK_SYNC_SAMPLES)
+_clock_offset = 0.0
+_clock_rtt = None
+_clock_lock = threading.Lock()
+
+_sensors = []
+_sensors_lock = threading.Lock()
+
+_startup_timings = {}
+_startup_timings_lock = threading.Lock()
+
 
 def _connect(url, timeout=10):
-    ws = create_connection(url, timeout=timeout)
+    try:
+        ws = create_connection(url, timeout=timeout)
+    except WebSocketBadStatusException as e:
+        # 421 means the robot moved to another shard; repoint the URLs so the
+        # caller's next attempt goes there.
+        if e.status_code == 421:
+            _follow_shard_redirect(e.resp_body)
+        raise
     return ws
 
 
+def _follow_shard_redirect(body):
+    try:
+        shard_url = json.loads(body.decode("utf-8")).get("url")
+    except Exception:
+        shard_url = None
+    if shard_url and shard_url.rstrip("/") != SERVER_HTTP:
+        print(f"Robot moved to shard {shard_url}")
+        _set_server(shard_url)
+    else:
+        _resolve_shard()
+
+
 def _register_robot():
     payload = json.dumps({"uuid": ROBOT_UUID, "type": ROBOT_TYPE}).encode("utf-8")
     req = urllib.request.Request(
@@ -95,6 +164,34 @@ def _register_robot():
         return False
 
 
+def _set_server(http_base):
+    global SERVER_HTTP, SERVER_BASE, WARMUP_URL
+    global VIDEO_URL, THERMAL_URL, COMMAND_URL, TELEMETRY_URL
+    SERVER_HTTP = http_base.rstrip("/")
+    SERVER_BASE = SERVER_HTTP.replace("https://", "wss://", 1).replace("http://", "ws://", 1)
+    WARMUP_URL = SERVER_HTTP
+    VIDEO_URL = f"{SERVER_BASE}/ws/video/robot/{ROBOT_UUID}"
+    THERMAL_URL = f"{SERVER_BASE}/ws/thermal/robot/{ROBOT_UUID}"
+    COMMAND_URL = f"{SERVER_BASE}/ws/command/robot/{ROBOT_UUID}"
+    TELEMETRY_URL = f"{SERVER_BASE}/ws/telemetry/robot/{ROBOT_UUID}"
+
+
+def _resolve_shard():
+    # A sharded relay names the shard that owns this robot; an unsharded one
+    # returns no url and everything stays pointed at SERVER_HTTP.
+    try:
+        url = f"{SERVER_HTTP}/api/robots/{ROBOT_UUID}/shard"
+        with urllib.request.urlopen(url, timeout=10) as resp:
+            shard_url = json.loads(resp.read().decode("utf-8")).get("url")
+    except Exception as e:
+        print(f"Shard lookup error: {e}")
+        return False
+    if shard_url and shard_url.rstrip("/") != SERVER_HTTP:
+        print(f"Robot served by shard {shard_url}")
+        _set_server(shard_url)
+    return True
+
+
 def _wake_server():
     for attempt in range(1, WARMUP_ATTEMPTS + 1):
         try:
@@ -115,20 +212,27 @@ def _wake_server():
 # -------------------------
 def _command_listener():
     ws = None
+    next_clock_sync = 0.0
     while True:
         if ws is None:
             try:
                 ws = _connect(COMMAND_URL, timeout=10)
                 ws.settimeout(5)
                 print("Command socket connected")
+                next_clock_sync = 0.0
             except Exception as e:
                 print(f"Command socket error: {e}")
                 time.sleep(2)
                 continue
         try:
+            if time.monotonic() >= next_clock_sync:
+                ws.send(json.dumps({"type": "clock_sync", "t0": time.time()}))
+                next_clock_sync = time.monotonic() + CLOCK_SYNC_INTERVAL_S
             msg = ws.recv()
             if msg is None:
                 raise RuntimeError("Command socket closed")
+            if _handle_clock_sync(msg):
+                continue
             print(f"[COMMAND] {msg}")  # logs kept
             _handle_command(msg)
         except WebSocketTimeoutException:
@@ -151,6 +255,23 @@ def _command_listener():
             time.sleep(1)
 
 
+def _handle_clock_sync(msg):
+    global _clock_offset, _clock_rtt
+    if not isinstance(msg, str) or '"clock_sync"' not in msg:
+        return False
+    t1 = time.time()
+    try:
+        payload = json.loads(msg)
+        t0 = float(payload["t0"])
+        server_time = float(payload["server_time"])
+    except Exception:
+        return False
+    with _clock_lock:
+        _clock_samples.append((t1 - t0, server_time - (t0 + t1) / 2))
+        _clock_rtt, _clock_offset = min(_clock_samples)
+    return True
+
+
 def _handle_command(msg):
     command = msg
     if isinstance(msg, str):
@@ -160,8 +281,8 @@ def _handle_command(msg):
                 speed = payload.get("speed")
                 if speed is not None:
                     _set_speed(speed)
-                forward_backward = payload.get("forwardBackward")
-                left_right = payload.get("leftRight")
+                forward_backward = _motion_axis(payload.get("forwardBackward"))
+                left_right = _motion_axis(payload.get("leftRight"))
                 if forward_backward is not None or left_right is not None:
                     _update_motion(
                         forward_backward=forward_backward, left_right=left_right
@@ -189,93 +310,294 @@ def _handle_command(msg):
         _update_motion(forward_backward=0, left_right=0)
 
 
+def _motion_axis(value):
+    # Command clients are untrusted; anything but -1/0/1 would otherwise end
+    # up in the motor state and the telemetry sampler.
+    if value is None:
+        return None
+    return max(-1, min(1, int(value)))
+
+
 # -------------------------
-# TELEMETRY SENDER (DISABLED)
+# TELEMETRY SAMPLER
 # -------------------------
-# def _telemetry_sender():
-#     ws = None
-#     while True:
-#         if ws is None:
-#             try:
-#                 ws = _connect(TELEMETRY_URL)
-#                 print("Telemetry socket connected")
-#             except Exception as e:
-#                 print(f"Telemetry socket error: {e}")
-#                 time.sleep(2)
-#                 continue
-#         max_temp = _get_max_temp()
-#         payload = {
-#             "uuid": ROBOT_UUID,
-#             "gas_ppm": 0,
-#             "temperature_c": max_temp,
-#             "ts": int(time.time()),
-#         }
-#         try:
-#             ws.send(json.dumps(payload))
-#         except Exception as e:
-#             print(f"Telemetry send error: {e}")
-#             try:
-#                 ws.close()
-#             except Exception:
-#                 pass
-#             ws = None
-#             time.sleep(1)
-#         time.sleep(1)
+def _register_sensor(name, rate_hz, read_fn, channels=1, scale=0.01):
+    # read_fn returns a scalar or a sequence of `channels` values, or None
+    # when no reading is available. Values are quantized to multiples of scale.
+    capacity = max(1, int(rate_hz * TELEMETRY_BUFFER_S))
+    sensor = {
+        "name": name,
+        "read": read_fn,
+        "channels": channels,
+        "scale": scale,
+        "period": 1.0 / rate_hz,
+        "next_due": time.monotonic(),
+        "buffers": [
+            (
+                np.zeros(capacity, dtype=np.float64),
+                np.zeros((capacity, channels), dtype=np.float32),
+            )
+            for _ in range(2)
+        ],
+        "active": 0,
+        "count": 0,
+        "dropped": 0,
+    }
+    with _sensors_lock:
+        _sensors.append(sensor)
+    return sensor
+
+
+def _record_sample(sensor, ts, value):
+    # A reading that is not numeric, has the wrong number of channels or is
+    # not finite is counted as dropped rather than stopping the sampler.
+    try:
+        row = np.asarray(value, dtype=np.float64).reshape(-1)
+    except (TypeError, ValueError):
+        row = None
+    if row is None or row.size != sensor["channels"] or not np.isfinite(row).all():
+        with _sensors_lock:
+            sensor["dropped"] += 1
+        return
+    with _sensors_lock:
+        count = sensor["count"]
+        ts_buf, values_buf = sensor["buffers"][sensor["active"]]
+        if count >= len(ts_buf):
+            sensor["dropped"] += 1
+            return
+        ts_buf[count] = ts
+        values_buf[count] = row
+        sensor["count"] = count + 1
+
+
+def _drain_sensors():
+    # Swap each sensor onto its spare buffer and hand back views of the filled
+    # one. Only the telemetry sender drains, and it finishes encoding before
+    # the next swap, so the views stay valid without copying.
+    batches = []
+    with _sensors_lock:
+        for sensor in _sensors:
+            count = sensor["count"]
+            if count == 0:
+                continue
+            ts_buf, values_buf = sensor["buffers"][sensor["active"]]
+            sensor["active"] ^= 1
+            sensor["count"] = 0
+            batches.append(
+                (
+                    sensor["name"],
+                    sensor["channels"],
+                    sensor["scale"],
+                    ts_buf[:count],
+                    values_buf[:count],
+                )
+            )
+    return batches
+
+
+def _encode_telemetry_batch(batches):
+    base_ms = int(min(ts[0] for _, _, _, ts, _ in batches) * 1000)
+    parts = [TELEMETRY_HEADER.pack(TELEMETRY_MAGIC, TELEMETRY_VERSION, len(batches), base_ms)]
+    for name, channels, scale, ts, values in batches:
+        ts_ms = (ts * 1000).astype(np.int64)
+        ts_deltas = np.diff(ts_ms, prepend=base_ms)
+        quantized = np.round(values / scale).astype(np.int64)
+        deltas = np.diff(quantized, axis=0, prepend=np.zeros((1, channels), np.int64))
+        if deltas.min() >= -32768 and deltas.max() <= 32767:
+            width, dtype = 2, "<i2"
+        else:
+            width, dtype = 4, "<i4"
+        encoded_name = name.encode("utf-8")
+        parts.append(bytes([len(encoded_name)]) + encoded_name)
+        parts.append(TELEMETRY_BLOCK.pack(channels, len(ts), width, scale))
+        parts.append(np.clip(ts_deltas, 0, 65535).astype("<u2").tobytes())
+        parts.append(deltas.astype(dtype).tobytes())
+    return b"".join(parts)
+
+
+def _sensor_sampler():
+    while True:
+        now = time.monotonic()
+        next_wake = now + 0.1
+        for sensor in list(_sensors):
+            if now >= sensor["next_due"]:
+                sensor["next_due"] += sensor["period"]
+                if sensor["next_due"] < now:
+                    sensor["next_due"] = now + sensor["period"]
+                try:
+                    value = sensor["read"]()
+                except Exception:
+                    value = None
+                if value is not None:
+                    _record_sample(sensor, time.time(), value)
+            next_wake = min(next_wake, sensor["next_due"])
+        delay = next_wake - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+
+def _read_motor_state():
+    return (_forward_backward, _left_right, _current_speed)
+
+
+def _read_cpu_temperature():
+    with open("/sys/class/thermal/thermal_zone0/temp", "r") as f:
+        return int(f.read().strip()) / 1000.0
+
+
+def _init_sensors():
+    # IMU, motor current and gas drivers plug in here via _register_sensor.
+    _register_sensor("motor", 20, _read_motor_state, channels=3, scale=1)
+    _register_sensor("cpu_temp", 2, _read_cpu_temperature)
+    _register_sensor("thermal", THERMAL_REFRESH_HZ, _read_thermal_stats, channels=5)
+
+
+def _telemetry_sender():
+    ws = None
+    interval = 1.0 / TELEMETRY_BATCH_HZ
+    next_send_time = time.monotonic()
+    while True:
+        now = time.monotonic()
+        if now < next_send_time:
+            time.sleep(next_send_time - now)
+        else:
+            next_send_time = now
+        next_send_time += interval
+        # Draining even while disconnected keeps the buffers from filling up
+        # with stale samples.
+        batches = _drain_sensors()
+        if ws is None:
+            try:
+                ws = _connect(TELEMETRY_URL)
+                print("Telemetry socket connected")
+            except Exception as e:
+                print(f"Telemetry socket error: {e}")
+                time.sleep(2)
+                continue
+        if not batches:
+            continue
+        try:
+            ws.send(_encode_telemetry_batch(batches), opcode=0x2)
+        except Exception as e:
+            print(f"Telemetry send error: {e}")
+            try:
+                ws.close()
+            except Exception:
+                pass
+            ws = None
+            time.sleep(1)
 
 
 # -------------------------
 # CAMERA CAPTURE (KEEP)
 # -------------------------
-def _open_capture(index, width, height, name, backend):
+def _open_capture(index, width, height, name, backend, fourcc="MJPG"):
     cap = cv2.VideoCapture(index, backend)
     if not cap.isOpened():
         return None
     cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
     cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
     cap.set(cv2.CAP_PROP_FPS, TARGET_FPS)
-    cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*"MJPG"))
+    cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*fourcc))
     cap.set(cv2.CAP_PROP_BUFFERSIZE, 2)
     return cap
 
 
-def _open_capture_with_fallbacks(width, height, name):
+def _load_camera_cache():
+    try:
+        with open(CAMERA_CACHE_PATH, "r", encoding="utf-8") as f:
+            cached = json.load(f)
+        return int(cached["index"]), int(cached["backend"]), str(cached["format"])
+    except Exception:
+        return None
+
+
+def _save_camera_cache(index, backend, fourcc):
+    payload = {"index": index, "backend": backend, "format": fourcc}
+    tmp_path = f"{CAMERA_CACHE_PATH}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(payload, f)
+        os.replace(tmp_path, CAMERA_CACHE_PATH)
+    except Exception as e:
+        print(f"Camera cache write error: {e}")
+
+
+def _camera_probe_order(cached):
     backends = [cv2.CAP_V4L2, cv2.CAP_ANY]
-    for index in USB_CAM_CANDIDATES:
-        for backend in backends:
-            cap = _open_capture(index, width, height, name, backend)
+    order = [(index, backend) for index in USB_CAM_CANDIDATES for backend in backends]
+    if cached is not None:
+        # Last known-good device goes first; the full matrix is the fallback.
+        order = [cached[:2]] + [combo for combo in order if combo != cached[:2]]
+    return order
+
+
+def _open_capture_with_fallbacks(width, height, name):
+    cached = _load_camera_cache()
+    for index, backend in _camera_probe_order(cached):
+        formats = USB_CAM_FORMATS
+        if cached is not None and (index, backend) == cached[:2]:
+            formats = [cached[2]] + [f for f in USB_CAM_FORMATS if f != cached[2]]
+        for fourcc in formats:
+            cap = _open_capture(index, width, height, name, backend, fourcc)
             if cap is None:
-                continue
+                # No device here; another pixel format will not help.
+                break
             ok, _ = cap.read()
             if ok:
-                print(f"{name} camera opened at index {index}")
+                print(f"{name} camera opened at index {index} ({fourcc})")
+                if (index, backend, fourcc) != cached:
+                    _save_camera_cache(index, backend, fourcc)
                 return cap
             cap.release()
     print(f"{name} camera not available on indexes: {USB_CAM_CANDIDATES}")
     return None
 
 
-def _capture_latest_frames(cap):
-    global _latest_usb_frame
-    while True:
+def _record_stage(stats, stage, wall_start, cpu_start, nbytes=0):
+    # Per-stage wall/CPU accounting for bench.py; a no-op in normal runs.
+    if stats is None:
+        return
+    entry = stats.setdefault(stage, {"count": 0, "wall": 0.0, "cpu": 0.0, "bytes": 0})
+    entry["count"] += 1
+    entry["wall"] += time.perf_counter() - wall_start
+    entry["cpu"] += time.thread_time() - cpu_start
+    entry["bytes"] += nbytes
+
+
+def _capture_latest_frames(cap, stats=None, stop=None):
+    global _latest_usb_frame, _latest_usb_frame_ts, _latest_usb_frame_id
+    while stop is None or not stop.is_set():
         if cap is None or not cap.isOpened():
             time.sleep(0.2)
             continue
+        wall_start, cpu_start = time.perf_counter(), time.thread_time()
         ok, frame = cap.read()
         if not ok:
             time.sleep(0.01)
             continue
+        _record_stage(stats, "capture", wall_start, cpu_start)
+        captured = time.time()
         with _latest_usb_lock:
             _latest_usb_frame = frame
+            _latest_usb_frame_ts = captured
+            _latest_usb_frame_id += 1
 
 
-def _video_sender(ws_url, target_fps, jpeg_quality):
+def _video_sender(ws_url, target_fps, jpeg_quality, stats=None, stop=None):
+    # ws_url=None follows VIDEO_URL, which changes when the robot's shard does.
     ws = None
     next_frame_time = time.monotonic()
-    while True:
+    frames_sent = 0
+    last_frame_id = -1
+    last_sent = None
+    while stop is None or not stop.is_set():
         if ws is None:
             try:
-                ws = _connect(ws_url)
+                ws = _connect(ws_url or VIDEO_URL)
                 print("Video socket connected")
+                last_frame_id = -1
+                last_sent = None
             except Exception as e:
                 print(f"Video socket error: {e}")
                 time.sleep(2)
@@ -285,20 +607,60 @@ def _video_sender(ws_url, target_fps, jpeg_quality):
             time.sleep(next_frame_time - now)
         else:
             next_frame_time = now
+        wall_start, cpu_start = time.perf_counter(), time.thread_time()
+        # A frame the capture thread has not replaced since the last send, or
+        # one that encodes to the same bytes, goes out as a tiny marker.
         with _latest_usb_lock:
-            frame = None if _latest_usb_frame is None else _latest_usb_frame.copy()
-        if frame is None:
+            frame_id = _latest_usb_frame_id
+            unchanged = frame_id == last_frame_id
+            frame = None
+            if _latest_usb_frame is not None and not unchanged:
+                frame = _latest_usb_frame.copy()
+            captured = _latest_usb_frame_ts
+        if frame is None and not unchanged:
             time.sleep(0.01)
             continue
-        ok, buffer = cv2.imencode(
-            ".jpg",
-            frame,
-            [int(cv2.IMWRITE_JPEG_QUALITY), jpeg_quality],
-        )
-        if not ok:
-            continue
+        data = None
+        if not unchanged:
+            _record_stage(stats, "copy", wall_start, cpu_start)
+            wall_start, cpu_start = time.perf_counter(), time.thread_time()
+            ok, buffer = cv2.imencode(
+                ".jpg",
+                frame,
+                [int(cv2.IMWRITE_JPEG_QUALITY), jpeg_quality],
+            )
+            if not ok:
+                continue
+            _record_stage(stats, "encode", wall_start, cpu_start, len(buffer))
+            data = buffer.tobytes()
+            unchanged = data == last_sent
+        encoded = time.time()
+        wall_start, cpu_start = time.perf_counter(), time.thread_time()
         try:
-            ws.send(buffer.tobytes(), opcode=0x2)
+            if unchanged:
+                ws.send(UNCHANGED_MESSAGE)
+                _record_stage(stats, "unchanged", wall_start, cpu_start, len(UNCHANGED_MESSAGE))
+                last_frame_id = frame_id
+                next_frame_time += 1.0 / target_fps
+                continue
+            with _clock_lock:
+                offset, rtt = _clock_offset, _clock_rtt
+            # Sent just ahead of the frame it describes, on the server clock.
+            # Until the first clock_sync reply the offset is unknown, and an
+            # unsynced Pi clock can be off by hours, so nothing is traced.
+            if rtt is not None and frames_sent % TRACE_SAMPLE_EVERY == 0:
+                trace = {
+                    "type": "trace",
+                    "capture": captured + offset,
+                    "encoded": encoded + offset,
+                    "clock_offset": offset,
+                    "clock_rtt": rtt,
+                }
+                ws.send(json.dumps(trace))
+            ws.send(data, opcode=0x2)
+            frames_sent += 1
+            last_frame_id = frame_id
+            last_sent = data
         except Exception as e:
             print(f"Video send error: {e}")
             try:
@@ -308,98 +670,182 @@ def _video_sender(ws_url, target_fps, jpeg_quality):
             ws = None
             time.sleep(1)
             continue
+        _record_stage(stats, "send", wall_start, cpu_start, len(data))
         next_frame_time += 1.0 / target_fps
+    if ws is not None:
+        ws.close()
 
 
 # -------------------------
-# THERMAL FUNCTIONS (DISABLED)
+# THERMAL PIPELINE
 # -------------------------
-# def _init_mlx():
-#     global _mlx
-#     try:
-#         i2c = busio.I2C(board.SCL, board.SDA, frequency=400000)
-#         mlx = adafruit_mlx90640.MLX90640(i2c)
-#         mlx.refresh_rate = adafruit_mlx90640.RefreshRate.REFRESH_2_HZ
-#         _mlx = mlx
-#         print("MLX90640 sensor initialized")
-#     except Exception as e:
-#         _mlx = None
-#         print(f"MLX90640 init error: {e}")
-#
-#
-# def _get_thermal_frame():
-#     if _mlx is None:
-#         return None
-#     frame = np.zeros(24 * 32, dtype=np.float32)
-#     try:
-#         with _mlx_lock:
-#             _mlx.getFrame(frame)
-#     except Exception:
-#         return None
-#     return frame.reshape((24, 32))
-#
-#
-# def _thermal_to_image(temp):
-#     temp = np.clip(temp, TEMP_MIN, TEMP_MAX)
-#     norm = (temp - TEMP_MIN) / (TEMP_MAX - TEMP_MIN)
-#     img = (norm * 255).astype(np.uint8)
-#     img = cv2.applyColorMap(img, cv2.COLORMAP_JET)
-#     img = cv2.resize(
-#         img, (THERMAL_FRAME_WIDTH, THERMAL_FRAME_HEIGHT), interpolation=cv2.INTER_CUBIC
-#     )
-#     return img
-#
-#
-# def _get_max_temp():
-#     temp = _get_thermal_frame()
-#     if temp is None:
-#         return None
-#     return float(np.max(temp))
-#
-#
-# def _thermal_sender():
-#     ws = None
-#     next_frame_time = time.monotonic()
-#     while True:
-#         if _mlx is None:
-#             time.sleep(2)
-#             continue
-#         if ws is None:
-#             try:
-#                 ws = _connect(THERMAL_URL)
-#                 print("Thermal socket connected")
-#             except Exception as e:
-#                 print(f"Thermal socket error: {e}")
-#                 time.sleep(2)
-#                 continue
-#         now = time.monotonic()
-#         if now < next_frame_time:
-#             time.sleep(next_frame_time - now)
-#         else:
-#             next_frame_time = now
-#         temp = _get_thermal_frame()
-#         if temp is None:
-#             continue
-#         image = _thermal_to_image(temp)
-#         ok, buffer = cv2.imencode(
-#             ".jpg",
-#             image,
-#             [int(cv2.IMWRITE_JPEG_QUALITY), THERMAL_JPEG_QUALITY],
-#         )
-#         if not ok:
-#             continue
-#         try:
-#             ws.send(buffer.tobytes(), opcode=0x2)
-#         except Exception as e:
-#             print(f"Thermal send error: {e}")
-#             try:
-#                 ws.close()
-#             except Exception:
-#                 pass
-#             ws = None
-#             time.sleep(1)
-#             continue
-#         next_frame_time += 1.0 / THERMAL_FPS
+class _SimulatedMLX:
+    """Stand-in for the MLX90640 driver: a warm spot drifting over a cool scene."""
+
+    def __init__(self, refresh_hz=THERMAL_REFRESH_HZ):
+        self.refresh_hz = refresh_hz
+        self._rows, self._cols = np.mgrid[0 : THERMAL_SHAPE[0], 0 : THERMAL_SHAPE[1]]
+        self._started = time.monotonic()
+
+    def getFrame(self, frame):
+        time.sleep(1.0 / self.refresh_hz)
+        t = time.monotonic() - self._started
+        row = 12 + 8 * np.sin(t * 0.7)
+        col = 16 + 12 * np.cos(t * 0.5)
+        dist = (self._rows - row) ** 2 + (self._cols - col) ** 2
+        frame[:] = (24.0 + 12.0 * np.exp(-dist / 18.0)).ravel()
+
+
+def _init_mlx():
+    global _mlx
+    if THERMAL_SOURCE == "sim":
+        _mlx = _SimulatedMLX()
+        print("Thermal source: simulated")
+        return
+    if adafruit_mlx90640 is None:
+        print("MLX90640 driver not available; thermal disabled")
+        return
+    try:
+        i2c = busio.I2C(board.SCL, board.SDA, frequency=400000)
+        mlx = adafruit_mlx90640.MLX90640(i2c)
+        mlx.refresh_rate = getattr(
+            adafruit_mlx90640.RefreshRate, f"REFRESH_{THERMAL_REFRESH_HZ}_HZ"
+        )
+        _mlx = mlx
+        print("MLX90640 sensor initialized")
+    except Exception as e:
+        _mlx = None
+        print(f"MLX90640 init error: {e}")
+
+
+def _thermal_frame_stats(temp):
+    hotspot = int(np.argmax(temp))
+    return {
+        "max": float(temp.flat[hotspot]),
+        "min": float(temp.min()),
+        "mean": float(temp.mean()),
+        "hotspot": divmod(hotspot, THERMAL_SHAPE[1]),
+    }
+
+
+def _thermal_reader(source):
+    # The only caller of getFrame, which blocks until the sensor has a new
+    # frame, so this loop runs at the sensor refresh rate.
+    global _thermal_front, _thermal_seq, _thermal_stats
+    flat = np.zeros(THERMAL_SHAPE[0] * THERMAL_SHAPE[1], dtype=np.float32)
+    while True:
+        try:
+            source.getFrame(flat)
+        except Exception:
+            time.sleep(0.1)
+            continue
+        back = _thermal_frames[_thermal_front ^ 1]
+        back[:] = flat.reshape(THERMAL_SHAPE)
+        stats = _thermal_frame_stats(back)
+        with _thermal_lock:
+            _thermal_front ^= 1
+            _thermal_seq += 1
+            _thermal_stats = stats
+
+
+def _latest_thermal_frame(out, last_seq):
+    # Copies the front frame into out if it is newer than last_seq.
+    with _thermal_lock:
+        if _thermal_seq == last_seq:
+            return last_seq
+        out[:] = _thermal_frames[_thermal_front]
+        return _thermal_seq
+
+
+def _read_thermal_stats():
+    with _thermal_lock:
+        stats = _thermal_stats
+    if stats is None:
+        return None
+    row, col = stats["hotspot"]
+    return (stats["max"], stats["min"], stats["mean"], row, col)
+
+
+def _build_colormap_lut(colormap=cv2.COLORMAP_JET):
+    gray = np.arange(256, dtype=np.uint8).reshape(256, 1)
+    return cv2.applyColorMap(gray, colormap).reshape(256, 3)
+
+
+def _thermal_render_buffers(width=THERMAL_FRAME_WIDTH, height=THERMAL_FRAME_HEIGHT):
+    return {
+        "lut": _build_colormap_lut(),
+        "norm": np.zeros(THERMAL_SHAPE, dtype=np.float32),
+        "index": np.zeros(THERMAL_SHAPE, dtype=np.uint8),
+        "color": np.zeros(THERMAL_SHAPE + (3,), dtype=np.uint8),
+        "image": np.zeros((height, width, 3), dtype=np.uint8),
+    }
+
+
+def _thermal_to_image(temp, buffers):
+    norm = buffers["norm"]
+    np.clip(temp, TEMP_MIN, TEMP_MAX, out=norm)
+    np.subtract(norm, TEMP_MIN, out=norm)
+    np.multiply(norm, 255.0 / (TEMP_MAX - TEMP_MIN), out=norm)
+    np.copyto(buffers["index"], norm, casting="unsafe")
+    np.take(buffers["lut"], buffers["index"], axis=0, out=buffers["color"])
+    image = buffers["image"]
+    cv2.resize(
+        buffers["color"],
+        (image.shape[1], image.shape[0]),
+        dst=image,
+        interpolation=cv2.INTER_CUBIC,
+    )
+    return image
+
+
+def _thermal_sender():
+    ws = None
+    buffers = _thermal_render_buffers()
+    temp = np.zeros(THERMAL_SHAPE, dtype=np.float32)
+    last_seq = 0
+    next_frame_time = time.monotonic()
+    while True:
+        if _mlx is None:
+            time.sleep(2)
+            continue
+        if ws is None:
+            try:
+                ws = _connect(THERMAL_URL)
+                print("Thermal socket connected")
+            except Exception as e:
+                print(f"Thermal socket error: {e}")
+                time.sleep(2)
+                continue
+        now = time.monotonic()
+        if now < next_frame_time:
+            time.sleep(next_frame_time - now)
+        else:
+            next_frame_time = now
+        seq = _latest_thermal_frame(temp, last_seq)
+        if seq == last_seq:
+            next_frame_time += 1.0 / THERMAL_FPS
+            continue
+        last_seq = seq
+        image = _thermal_to_image(temp, buffers)
+        ok, buffer = cv2.imencode(
+            ".jpg",
+            image,
+            [int(cv2.IMWRITE_JPEG_QUALITY), THERMAL_JPEG_QUALITY],
+        )
+        if not ok:
+            continue
+        try:
+            ws.send(buffer.tobytes(), opcode=0x2)
+        except Exception as e:
+            print(f"Thermal send error: {e}")
+            try:
+                ws.close()
+            except Exception:
+                pass
+            ws = None
+            time.sleep(1)
+            continue
+        next_frame_time += 1.0 / THERMAL_FPS
 
 
 # -------------------------
@@ -497,31 +943,94 @@ def _apply_motor_state():
         GPIO.output(MOTOR_PINS["motor2Pin2"], GPIO.LOW)
 
 
-if __name__ == "__main__":
-    _wake_server()
-    _register_robot()
-    _setup_gpio()
+# -------------------------
+# STARTUP ORCHESTRATION
+# -------------------------
+def _timed_stage(name, fn, *args):
+    start = time.monotonic()
+    try:
+        return fn(*args)
+    finally:
+        with _startup_timings_lock:
+            _startup_timings[name] = time.monotonic() - start
 
-    # --- THERMAL INIT DISABLED ---
-    # _init_mlx()
 
-    usb_cap = _open_capture_with_fallbacks(FRAME_WIDTH, FRAME_HEIGHT, "USB")
+def _run_stage_into(results, name, fn, *args):
+    results[name] = _timed_stage(name, fn, *args)
 
-    threading.Thread(target=_command_listener, daemon=True).start()
 
-    # --- SENSOR TELEMETRY DISABLED ---
-    # threading.Thread(target=_telemetry_sender, daemon=True).start()
+def _startup_server():
+    # Registration itself wakes a sleeping server, so it runs alongside the
+    # warm-up; the shard lookup and registration are only retried if the
+    # first attempts lost that race.
+    results = {}
+    warmup = threading.Thread(
+        target=_run_stage_into, args=(results, "warmup", _wake_server), daemon=True
+    )
+    warmup.start()
+    resolved = _timed_stage("shard", _resolve_shard)
+    registered = _timed_stage("register", _register_robot)
+    warmup.join()
+    if results.get("warmup"):
+        if not resolved:
+            resolved = _timed_stage("shard_retry", _resolve_shard)
+            # Registering before the lookup may have reached the wrong shard.
+            registered = False
+        if not registered:
+            registered = _timed_stage("register_retry", _register_robot)
+    return registered
 
-    threading.Thread(target=_capture_latest_frames, args=(usb_cap,), daemon=True).start()
+
+def _startup():
+    started = time.monotonic()
+    results = {}
+    stages = [
+        ("gpio", _setup_gpio, ()),
+        ("thermal", _init_mlx, ()),
+        ("camera", _open_capture_with_fallbacks, (FRAME_WIDTH, FRAME_HEIGHT, "USB")),
+    ]
+    workers = [threading.Thread(target=_startup_server, daemon=True)]
+    workers += [
+        threading.Thread(
+            target=_run_stage_into, args=(results, name, fn) + args, daemon=True
+        )
+        for name, fn, args in stages
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    with _startup_timings_lock:
+        _startup_timings["total"] = time.monotonic() - started
+        breakdown = " ".join(
+            f"{name}={elapsed:.2f}s" for name, elapsed in _startup_timings.items()
+        )
+    print(f"Startup timings: {breakdown}")
+    return results.get("camera")
+
+
+if __name__ == "__main__":
+    # Socket threads start after _startup so they use the resolved shard URLs.
+    usb_cap = _startup()
 
     threading.Thread(
         target=_video_sender,
-        args=(VIDEO_URL, TARGET_FPS, JPEG_QUALITY),
+        args=(None, TARGET_FPS, JPEG_QUALITY),
         daemon=True,
     ).start()
 
-    # --- THERMAL STREAM DISABLED ---
-    # threading.Thread(target=_thermal_sender, daemon=True).start()
+    threading.Thread(target=_command_listener, daemon=True).start()
+
+    _init_sensors()
+    threading.Thread(target=_sensor_sampler, daemon=True).start()
+    threading.Thread(target=_telemetry_sender, daemon=True).start()
+
+    threading.Thread(target=_capture_latest_frames, args=(usb_cap,), daemon=True).start()
+
+    if _mlx is not None:
+        threading.Thread(target=_thermal_reader, args=(_mlx,), daemon=True).start()
+    threading.Thread(target=_thermal_sender, daemon=True).start()
 
     while True:
-        time.sleep(1)
\ No newline at end of file
+        time.sleep(1)
@@ -1,29 +1,122 @@
+import hashlib
+import json
 import os
+import struct
+import sys
+import threading
+import time
+import urllib.request
+import uuid
+import zlib
+from array import array
+from collections import OrderedDict, deque
+from itertools import accumulate, count
+
 from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
 from flask_sock import Sock
-import threading
-import time
 
 app = Flask(__name__)
-CORS(app, resources={r"/api/*": {"origins": "*"}})
+CORS(app, resources={r"/api/*": {"origins": "*"}, r"/segments/*": {"origins": "*"}})
 sock = Sock(app)
 
 robots = {}
 robots_lock = threading.Lock()
 ONLINE_TTL_SECONDS = 30
+ROBOT_STATE_TTL_SECONDS = int(os.environ.get("ROBOT_STATE_TTL_SECONDS", 600))
+SWEEP_INTERVAL_SECONDS = 10
+MAX_FRAME_BYTES = int(os.environ.get("MAX_FRAME_BYTES", 1024 * 1024))
+FRAME_MEMORY_BUDGET_BYTES = int(os.environ.get("FRAME_MEMORY_BUDGET_BYTES", 64 * 1024 * 1024))
+memory_stats = {
+    "evicted_robots": 0,
+    "oversized_frames": 0,
+    "budget_evictions": 0,
+    "segment_frames_dropped": 0,
+}
+memory_stats_lock = threading.Lock()
 
 video_clients = {}
 video_clients_lock = threading.Lock()
 latest_frames = {}
 latest_frame_seq = {}
+latest_frame_hash = {}
 latest_frames_lock = threading.Lock()
+video_stats = {}
+video_stats_lock = threading.Lock()
+
+# Per-robot token buckets for video/thermal ingest, charged only for the
+# bytes the robot itself uploads. Command and telemetry are never throttled.
+INGEST_BYTES_PER_SEC = int(os.environ.get("INGEST_BYTES_PER_SEC", 2 * 1024 * 1024))
+INGEST_BURST_BYTES = int(os.environ.get("INGEST_BURST_BYTES", 4 * 1024 * 1024))
+ingest_buckets = {}
+ingest_lock = threading.Lock()
+
+# Video fan-out runs in a worker per robot connection that only keeps the
+# newest frame, so slow fan-out makes viewers skip frames instead of stalling
+# ingest. VIDEO_FANOUT_BYTES_PER_SEC optionally caps bytes sent to one
+# robot's viewers per second; 0 means unlimited.
+VIDEO_FANOUT_BYTES_PER_SEC = int(os.environ.get("VIDEO_FANOUT_BYTES_PER_SEC", 0))
+# While command or telemetry messages are being relayed, video and thermal
+# fan-out wait (up to this long) so control sends go first. This orders sends
+# within one process; it cannot preempt a video send already in progress.
+CONTROL_PRIORITY_WAIT_SECONDS = 0.05
+control_inflight = 0
+control_idle = threading.Event()
+control_idle.set()
+control_lock = threading.Lock()
+
+# Optional sharding: SHARD_URLS lists every shard's base URL and SHARD_INDEX
+# is this process. Robots map to shards by a stable hash of their id.
+SHARD_URLS = [
+    url.strip().rstrip("/")
+    for url in os.environ.get("SHARD_URLS", "").split(",")
+    if url.strip()
+]
+SHARD_INDEX = int(os.environ.get("SHARD_INDEX", 0))
+
+SEGMENT_SECONDS = 1.0
+SEGMENT_WINDOW = 6
+SEGMENT_IDLE_SECONDS = 30
+SEGMENT_CACHE_SECONDS = 86400
+SEGMENT_MAX_BYTES = 1024 * 1024
+# Segment body: per frame, offset from segment start in ms and JPEG length.
+SEGMENT_FRAME_HEADER = struct.Struct(">II")
+segments = {}
+segments_lock = threading.Lock()
+
+MODEL_API_URL = os.environ.get(
+    "MODEL_API_URL", "https://leaf-disease-api-v3fr.onrender.com/predict"
+)  # "local" uses the built-in stand-in model
+MODEL_API_TIMEOUT_SECONDS = 30
+MODEL_IMAGE_FIELD = "file"
+PREDICT_CACHE_SIZE = 128
+PREDICT_CACHE_TTL_SECONDS = 300
+predict_cache = OrderedDict()
+predict_inflight = {}
+predict_stats = {
+    "hits": 0,
+    "misses": 0,
+    "coalesced": 0,
+    "upstream_calls": 0,
+    "upstream_errors": 0,
+    "upstream_ms_total": 0.0,
+    "upstream_ms_max": 0.0,
+    "upstream_ms_last": None,
+}
+predict_lock = threading.Lock()
+
+TRACE_HISTORY = 200
+TRACE_PENDING = 32
+latency_traces = {}
+latency_lock = threading.Lock()
+trace_ids = count(1)
 
 thermal_clients = {}
 thermal_clients_lock = threading.Lock()
 latest_thermal_frames = {}
 latest_thermal_seq = {}
 latest_thermal_lock = threading.Lock()
+thermal_stats = {"throttled": 0}
 
 command_robot = {}
 command_clients = {}
@@ -32,6 +125,32 @@ command_lock = threading.Lock()
 telemetry_clients = {}
 telemetry_lock = threading.Lock()
 
+TELEMETRY_MAGIC = b"LT"
+TELEMETRY_VERSION = 2
+TELEMETRY_HEADER = struct.Struct("<2sBBQ")
+TELEMETRY_BLOCK = struct.Struct("<BHBd")
+TELEMETRY_FORMATS = ("json", "binary")
+
+SSE_BUFFER_SIZE = 256
+SSE_KEEPALIVE_SECONDS = 15
+SSE_RETRY_MS = 3000
+PRESENCE_CHECK_SECONDS = 5
+PRESENCE_LOG = "*"
+event_logs = {}
+event_logs_lock = threading.Lock()
+
+
+@app.before_request
+def route_to_shard():
+    robot_id = (request.view_args or {}).get("robot_id")
+    if robot_id is None or request.endpoint == "robot_shard":
+        return None
+    shard = _shard_for(robot_id)
+    if shard == SHARD_INDEX:
+        return None
+    payload = {"error": "robot served by another shard", "shard": shard, "url": SHARD_URLS[shard]}
+    return jsonify(payload), 421
+
 
 @app.route("/", methods=["GET"])
 def home():
@@ -53,16 +172,7 @@ def health():
 @app.route("/api/robots", methods=["GET"])
 def list_robots():
     online_only = request.args.get("online") == "1"
-    with robots_lock:
-        data = [
-            {
-                "uuid": rid,
-                "type": info.get("type"),
-                "last_seen": info.get("last_seen"),
-                "online": _is_online(info),
-            }
-            for rid, info in robots.items()
-        ]
+    data = _robot_snapshot()
     if online_only:
         data = [robot for robot in data if robot.get("online")]
     return jsonify({"robots": data})
@@ -79,6 +189,126 @@ def register_robot():
     return jsonify({"ok": True, "uuid": robot_id})
 
 
+@app.route("/api/robots/events", methods=["GET"])
+def robot_presence_events():
+    return _sse_response(PRESENCE_LOG, lambda: {"robots": _robot_snapshot()})
+
+
+@app.route("/api/robots/<robot_id>/events", methods=["GET"])
+def robot_events(robot_id):
+    return _sse_response(robot_id, lambda: _robot_snapshot(robot_id)[0])
+
+
+@app.route("/api/robots/<robot_id>/predict", methods=["POST"])
+def predict_robot_frame(robot_id):
+    with latest_frames_lock:
+        data = latest_frames.get(robot_id)
+        seq = latest_frame_seq.get(robot_id, 0)
+    if not data:
+        return jsonify({"error": "no frame available"}), 404
+    try:
+        payload, cache = _cached_prediction(robot_id, data)
+    except Exception as e:
+        return jsonify({"error": f"model error: {e}"}), 502
+    return jsonify(
+        {"uuid": robot_id, "frame_seq": seq, "cache": cache, "prediction": payload}
+    )
+
+
+@app.route("/api/predict/stats", methods=["GET"])
+def predict_stats_view():
+    with predict_lock:
+        stats = dict(predict_stats)
+        stats["cached"] = len(predict_cache)
+        stats["inflight"] = len(predict_inflight)
+    lookups = stats["hits"] + stats["misses"] + stats["coalesced"]
+    calls = stats["upstream_calls"]
+    stats["hit_rate"] = (stats["hits"] + stats["coalesced"]) / lookups if lookups else None
+    stats["upstream_ms_avg"] = stats.pop("upstream_ms_total") / calls if calls else None
+    return jsonify(stats)
+
+
+@app.route("/api/robots/<robot_id>/latency", methods=["GET"])
+def robot_latency(robot_id):
+    with latency_lock:
+        state = latency_traces.get(robot_id)
+        frames = list(state["frames"]) if state else []
+        displays = list(state["displays"]) if state else []
+        clock = dict(state["clock"]) if state else {}
+    # Traces taken before the robot's first clock sync are not comparable.
+    frames = [t for t in frames if t["clock_rtt"] is not None]
+    displays = [t for t in displays if t["clock_rtt"] is not None]
+    stages = {
+        "capture_to_encode": [t["encoded"] - t["capture"] for t in frames],
+        "uplink": [t["received"] - t["encoded"] for t in frames],
+        "relay": [t["fanout"] - t["received"] for t in frames],
+        "downlink_display": [t["displayed"] - t["fanout"] for t in displays],
+        "glass_to_glass": [t["displayed"] - t["capture"] for t in displays],
+    }
+    return jsonify(
+        {
+            "uuid": robot_id,
+            "sampled_frames": len(frames),
+            "displays": len(displays),
+            "clock": clock,
+            "stages": {name: _summarize_ms(values) for name, values in stages.items()},
+        }
+    )
+
+
+@app.route("/api/video/stats", methods=["GET"])
+def video_stats_view():
+    with video_stats_lock:
+        per_robot = {rid: dict(counts) for rid, counts in video_stats.items()}
+    totals = {
+        "frames": 0,
+        "duplicates": 0,
+        "unchanged_markers": 0,
+        "throttled": 0,
+        "fanout_skipped": 0,
+    }
+    for counts in per_robot.values():
+        for key, value in counts.items():
+            totals[key] += value
+    # Fan-out skips are frames already counted as received.
+    received = sum(totals.values()) - totals["fanout_skipped"]
+    totals["suppressed_ratio"] = (
+        (totals["duplicates"] + totals["unchanged_markers"]) / received if received else None
+    )
+    with latest_thermal_lock:
+        thermal = dict(thermal_stats)
+    return jsonify({"totals": totals, "robots": per_robot, "thermal": thermal})
+
+
+@app.route("/api/memory", methods=["GET"])
+def memory_view():
+    per_robot = _retained_bytes_by_robot()
+    totals = {"frames": 0, "thermal": 0, "segments": 0}
+    for usage in per_robot.values():
+        for kind, size in usage.items():
+            totals[kind] += size
+    with memory_stats_lock:
+        stats = dict(memory_stats)
+    with robots_lock:
+        stats["robots"] = len(robots)
+    stats["retained_bytes"] = sum(totals.values())
+    stats["retained_by_kind"] = totals
+    stats["budget_bytes"] = FRAME_MEMORY_BUDGET_BYTES
+    stats["max_frame_bytes"] = MAX_FRAME_BYTES
+    if request.args.get("detail") == "1":
+        stats["retained_by_robot"] = per_robot
+    return jsonify(stats)
+
+
+@app.route("/api/robots/<robot_id>/shard", methods=["GET"])
+def robot_shard(robot_id):
+    # url is null when sharding is off: the caller keeps using this server.
+    shard = _shard_for(robot_id)
+    return jsonify(
+        {"uuid": robot_id, "shard": shard, "url": SHARD_URLS[shard] if SHARD_URLS else None}
+    )
+
+
 @app.route("/api/clients/register", methods=["POST"])
 def register_client():
     payload = request.get_json(force=True, silent=True) or {}
@@ -92,19 +322,37 @@ def register_client():
 def ws_video_robot(ws, robot_id):
     print(f"[ws] video robot connected: {robot_id}")
     _touch_robot(robot_id)
+    trace = None
+    fanout = _start_video_fanout(robot_id)
     try:
         while True:
             data = ws.receive()
             if data is None:
                 break
             if isinstance(data, str):
+                if _is_unchanged_marker(data):
+                    # The robot has no new frame; keep it alive, send nothing.
+                    _touch_robot(robot_id)
+                    _count_video(robot_id, "unchanged_markers")
+                    _tick_segment(robot_id)
+                    trace = None
+                    continue
+                # A trace message describes the binary frame that follows it.
+                trace = _parse_trace(data)
                 continue
+            received = time.time()
             _touch_robot(robot_id)
-            with latest_frames_lock:
-                latest_frames[robot_id] = data
-                latest_frame_seq[robot_id] = latest_frame_seq.get(robot_id, 0) + 1
-            _broadcast_video(robot_id, data)
+            if _oversized_frame(robot_id, data):
+                trace = None
+                continue
+            if not _ingest_allowed(robot_id, len(data)):
+                _count_video(robot_id, "throttled")
+                trace = None
+                continue
+            _ingest_video_frame(robot_id, data, trace, received, fanout)
+            trace = None
     finally:
+        _stop_video_fanout(fanout)
         print(f"[ws] video robot disconnected: {robot_id}")
 
 
@@ -122,6 +370,8 @@ def ws_video_client(ws, robot_id):
             msg = ws.receive()
             if msg is None:
                 break
+            if isinstance(msg, str):
+                _handle_viewer_trace_message(ws, robot_id, msg)
     finally:
         with video_clients_lock:
             clients = video_clients.get(robot_id, set())
@@ -141,9 +391,16 @@ def ws_thermal_robot(ws, robot_id):
             if isinstance(data, str):
                 continue
             _touch_robot(robot_id)
+            if _oversized_frame(robot_id, data):
+                continue
+            if not _ingest_allowed(robot_id, len(data)):
+                with latest_thermal_lock:
+                    thermal_stats["throttled"] += 1
+                continue
             with latest_thermal_lock:
                 latest_thermal_frames[robot_id] = data
                 latest_thermal_seq[robot_id] = latest_thermal_seq.get(robot_id, 0) + 1
+            _wait_for_control()
             _broadcast_thermal(robot_id, data)
     finally:
         print(f"[ws] thermal robot disconnected: {robot_id}")
@@ -182,7 +439,13 @@ def ws_command_robot(ws, robot_id):
             if msg is None:
                 break
             _touch_robot(robot_id)
-            _broadcast_command(robot_id, msg, source="robot")
+            if _reply_clock_sync(ws, msg):
+                continue
+            _begin_control()
+            try:
+                _broadcast_command(robot_id, msg, source="robot")
+            finally:
+                _end_control()
     finally:
         with command_lock:
             if command_robot.get(robot_id) is ws:
@@ -200,7 +463,11 @@ def ws_command_client(ws, robot_id):
             msg = ws.receive()
             if msg is None:
                 break
-            _send_command_to_robot(robot_id, msg)
+            _begin_control()
+            try:
+                _send_command_to_robot(robot_id, msg)
+            finally:
+                _end_control()
     finally:
         with command_lock:
             clients = command_clients.get(robot_id, set())
@@ -218,7 +485,11 @@ def ws_telemetry_robot(ws, robot_id):
             if msg is None:
                 break
             _touch_robot(robot_id)
-            _broadcast_telemetry(robot_id, msg)
+            _begin_control()
+            try:
+                _broadcast_telemetry(robot_id, msg)
+            finally:
+                _end_control()
     finally:
         print(f"[ws] telemetry robot disconnected: {robot_id}")
 
@@ -226,8 +497,11 @@ def ws_telemetry_robot(ws, robot_id):
 @sock.route("/ws/telemetry/client/<robot_id>")
 def ws_telemetry_client(ws, robot_id):
     print(f"[ws] telemetry client connected: {robot_id}")
+    fmt = request.args.get("format", "json")
+    if fmt not in TELEMETRY_FORMATS:
+        fmt = "json"
     with telemetry_lock:
-        telemetry_clients.setdefault(robot_id, set()).add(ws)
+        telemetry_clients.setdefault(robot_id, {})[ws] = fmt
     try:
         while True:
             msg = ws.receive()
@@ -235,33 +509,135 @@ def ws_telemetry_client(ws, robot_id):
                 break
     finally:
         with telemetry_lock:
-            clients = telemetry_clients.get(robot_id, set())
-            clients.discard(ws)
+            clients = telemetry_clients.get(robot_id, {})
+            clients.pop(ws, None)
         print(f"[ws] telemetry client disconnected: {robot_id}")
 
 
 def _broadcast_video(robot_id, data):
+    # Returns how many viewers the frame reached.
     dead = []
     with video_clients_lock:
-        for client in video_clients.get(robot_id, set()):
+        clients = video_clients.get(robot_id, set())
+        for client in clients:
             try:
                 client.send(data)
             except Exception:
                 dead.append(client)
         for client in dead:
-            video_clients.get(robot_id, set()).discard(client)
+            clients.discard(client)
+        return len(clients)
+
+
+def _ingest_video_frame(robot_id, data, trace, received, fanout=None):
+    # With a fan-out worker the frame is queued for it; without one (tools
+    # and tests) it is sent to viewers inline.
+    fingerprint = hashlib.blake2b(data, digest_size=16).digest()
+    with latest_frames_lock:
+        duplicate = latest_frame_hash.get(robot_id) == fingerprint
+        if not duplicate:
+            latest_frames[robot_id] = data
+            latest_frame_seq[robot_id] = latest_frame_seq.get(robot_id, 0) + 1
+            latest_frame_hash[robot_id] = fingerprint
+    _count_video(robot_id, "duplicates" if duplicate else "frames")
+    if duplicate:
+        _tick_segment(robot_id)
+        return
+    if trace is not None:
+        trace["received"] = received
+    if fanout is None:
+        _fan_out_video_frame(robot_id, data, trace)
+    else:
+        _queue_video_fanout(fanout, data, trace)
+    _append_segment_frame(robot_id, data)
+
+
+def _fan_out_video_frame(robot_id, data, trace):
+    # Returns how many viewers the frame reached.
+    if trace is not None:
+        _broadcast_video(
+            robot_id, json.dumps({"type": "trace", "id": trace["id"]})
+        )
+    viewers = _broadcast_video(robot_id, data)
+    if trace is not None:
+        trace["fanout"] = time.time()
+        _record_frame_trace(robot_id, trace)
+    return viewers
+
+
+def _start_video_fanout(robot_id):
+    fanout = {
+        "robot": robot_id,
+        "pending": None,
+        "closed": False,
+        "cond": threading.Condition(),
+        "allowance": VIDEO_FANOUT_BYTES_PER_SEC,
+        "updated": time.monotonic(),
+    }
+    threading.Thread(target=_video_fanout_worker, args=(fanout,), daemon=True).start()
+    return fanout
+
+
+def _queue_video_fanout(fanout, data, trace):
+    with fanout["cond"]:
+        replaced = fanout["pending"] is not None
+        fanout["pending"] = (data, trace)
+        fanout["cond"].notify()
+    if replaced:
+        _count_video(fanout["robot"], "fanout_skipped")
+
+
+def _stop_video_fanout(fanout):
+    with fanout["cond"]:
+        fanout["closed"] = True
+        fanout["cond"].notify()
+
+
+def _video_fanout_worker(fanout):
+    robot_id = fanout["robot"]
+    while True:
+        with fanout["cond"]:
+            while fanout["pending"] is None and not fanout["closed"]:
+                fanout["cond"].wait()
+            if fanout["pending"] is None:
+                return
+            data, trace = fanout["pending"]
+            fanout["pending"] = None
+        _wait_for_control()
+        if not _fanout_allowed(fanout):
+            _count_video(robot_id, "fanout_skipped")
+            continue
+        viewers = _fan_out_video_frame(robot_id, data, trace)
+        fanout["allowance"] -= len(data) * viewers
+
+
+def _fanout_allowed(fanout):
+    # Only called from the fan-out worker, which owns the allowance. It may
+    # go negative after a large send; frames are skipped until it refills.
+    if VIDEO_FANOUT_BYTES_PER_SEC <= 0:
+        return True
+    now = time.monotonic()
+    fanout["allowance"] = min(
+        VIDEO_FANOUT_BYTES_PER_SEC,
+        fanout["allowance"] + (now - fanout["updated"]) * VIDEO_FANOUT_BYTES_PER_SEC,
+    )
+    fanout["updated"] = now
+    return fanout["allowance"] > 0
 
 
 def _broadcast_thermal(robot_id, data):
+    # Returns how many viewers the frame reached.
     dead = []
     with thermal_clients_lock:
-        for client in thermal_clients.get(robot_id, set()):
+        clients = thermal_clients.get(robot_id, set())
+        for client in clients:
             try:
                 client.send(data)
             except Exception:
                 dead.append(client)
         for client in dead:
-            thermal_clients.get(robot_id, set()).discard(client)
+            clients.discard(client)
+        return len(clients)
 
 
 def _mjpeg_stream(robot_id, fps=8):
@@ -291,6 +667,139 @@ def mjpeg_stream(robot_id):
     )
 
 
+@app.route("/segments/<robot_id>/playlist.json")
+def segment_playlist(robot_id):
+    with segments_lock:
+        state = segments.get(robot_id)
+        if state is None:
+            state = segments[robot_id] = _new_segment_state()
+        state["watched_at"] = time.time()
+        _close_due_segment(state, state["watched_at"])
+        items = [
+            {
+                "seq": seg["seq"],
+                "started": seg["started"],
+                "duration": seg["duration"],
+                "frames": seg["frames"],
+                "bytes": len(seg["body"]),
+            }
+            for seg in state["closed"]
+        ]
+    response = jsonify(
+        {"robot": robot_id, "target_duration": SEGMENT_SECONDS, "segments": items}
+    )
+    response.headers["Cache-Control"] = "public, max-age=1"
+    return response
+
+
+@app.route("/segments/<robot_id>/<int:seq>.seg")
+def segment_data(robot_id, seq):
+    with segments_lock:
+        state = segments.get(robot_id)
+        body = None
+        if state is not None:
+            for seg in state["closed"]:
+                if seg["seq"] == seq:
+                    body = seg["body"]
+                    break
+    if body is None:
+        return jsonify({"error": "segment not found"}), 404
+    response = Response(body, mimetype="application/octet-stream")
+    response.headers["Cache-Control"] = (
+        f"public, max-age={SEGMENT_CACHE_SECONDS}, immutable"
+    )
+    response.set_etag(f"{robot_id}-{seq}")
+    return response.make_conditional(request)
+
+
+def _new_segment_state():
+    # Sequence numbers start at the current time in ms so segment URLs are
+    # never reused after a restart, which would serve stale cached bodies.
+    return {
+        "open": None,
+        "closed": deque(maxlen=SEGMENT_WINDOW),
+        "next_seq": int(time.time() * 1000),
+        "watched_at": 0,
+    }
+
+
+def _append_segment_frame(robot_id, data):
+    # Segments are only built while someone has fetched the playlist recently.
+    now = time.time()
+    with segments_lock:
+        state = segments.get(robot_id)
+        if state is None:
+            return
+        if now - state["watched_at"] > SEGMENT_IDLE_SECONDS:
+            # Nobody is watching; release the buffered segments too.
+            state["open"] = None
+            state["closed"].clear()
+            return
+        if len(data) > SEGMENT_MAX_BYTES:
+            # A single frame larger than a whole segment can never fit.
+            with memory_stats_lock:
+                memory_stats["segment_frames_dropped"] += 1
+            return
+        _close_due_segment(state, now)
+        current = state["open"]
+        if current is not None and current["bytes"] + len(data) > SEGMENT_MAX_BYTES:
+            # Roll over early when the byte cap is hit so large frames start
+            # the next segment instead of being discarded.
+            state["closed"].append(_close_segment(current, now))
+            current = None
+        if current is None:
+            current = state["open"] = {
+                "seq": state["next_seq"],
+                "started": now,
+                "frames": [],
+                "bytes": 0,
+            }
+            state["next_seq"] += 1
+        current["frames"].append((now, data))
+        current["bytes"] += len(data)
+
+
+def _close_due_segment(state, now):
+    # Called with segments_lock held. Closes the open segment once it has
+    # run its target length, whether or not a new frame has arrived.
+    current = state["open"]
+    if current is not None and now - current["started"] >= SEGMENT_SECONDS:
+        state["closed"].append(_close_segment(current, now))
+        state["open"] = None
+
+
+def _tick_segment(robot_id):
+    # Unchanged markers and duplicate frames add nothing to the segment but
+    # still mark time passing on the robot.
+    with segments_lock:
+        state = segments.get(robot_id)
+        if state is not None:
+            _close_due_segment(state, time.time())
+
+
+def _close_segment(segment, ended):
+    started = segment["started"]
+    parts = []
+    offsets = []
+    for ts, data in segment["frames"]:
+        offsets.append(ts - started)
+        parts.append(SEGMENT_FRAME_HEADER.pack(int((ts - started) * 1000), len(data)))
+        parts.append(data)
+    # A segment closed late (the robot paused) would otherwise claim the whole
+    # gap; end it one frame interval after its last frame instead.
+    if len(offsets) > 1:
+        interval = (offsets[-1] - offsets[0]) / (len(offsets) - 1)
+    else:
+        interval = SEGMENT_SECONDS
+    return {
+        "seq": segment["seq"],
+        "started": started,
+        "duration": min(ended - started, offsets[-1] + interval),
+        "frames": len(segment["frames"]),
+        "body": b"".join(parts),
+    }
+
+
 def _mjpeg_stream_thermal(robot_id, fps=8):
     boundary = "frame"
     last_seq = -1
@@ -341,16 +850,615 @@ def _send_command_to_robot(robot_id, msg):
         pass
 
 
+def _decode_telemetry_packet(data):
+    magic, version, sensor_count, base_ms = TELEMETRY_HEADER.unpack_from(data, 0)
+    if magic != TELEMETRY_MAGIC or version != TELEMETRY_VERSION:
+        raise ValueError("unsupported telemetry packet")
+    offset = TELEMETRY_HEADER.size
+    sensors = {}
+    for _ in range(sensor_count):
+        name_len = data[offset]
+        name = bytes(data[offset + 1 : offset + 1 + name_len]).decode("utf-8")
+        offset += 1 + name_len
+        channels, count, width, scale = TELEMETRY_BLOCK.unpack_from(data, offset)
+        offset += TELEMETRY_BLOCK.size
+        ts_deltas = array("H")
+        ts_deltas.frombytes(data[offset : offset + 2 * count])
+        offset += 2 * count
+        deltas = array("h" if width == 2 else "i")
+        deltas.frombytes(data[offset : offset + width * count * channels])
+        offset += width * count * channels
+        if sys.byteorder == "big":
+            ts_deltas.byteswap()
+            deltas.byteswap()
+        current = [0] * channels
+        rows = []
+        for i in range(0, count * channels, channels):
+            current = [c + d for c, d in zip(current, deltas[i : i + channels])]
+            rows.append([round(c * scale, 6) for c in current])
+        sensors[name] = {
+            "ts": list(accumulate(ts_deltas, initial=base_ms))[1:],
+            "values": rows,
+        }
+    return {"ts": base_ms, "sensors": sensors}
+
+
+def _is_telemetry_packet(msg):
+    return isinstance(msg, (bytes, bytearray)) and msg[:2] == TELEMETRY_MAGIC
+
+
 def _broadcast_telemetry(robot_id, msg):
+    # Binary packets go out untouched to binary viewers; everyone else,
+    # including the SSE replay buffer, gets the same JSON rendering.
+    packet = _is_telemetry_packet(msg)
+    json_msg = msg
+    if packet:
+        try:
+            decoded = _decode_telemetry_packet(msg)
+        except Exception as e:
+            # Binary viewers may understand a packet this relay cannot.
+            print(f"[ws] telemetry decode error for {robot_id}: {e}")
+            _send_telemetry(robot_id, msg, formats=("binary",))
+            return
+        decoded["uuid"] = robot_id
+        json_msg = json.dumps(decoded)
+    if isinstance(json_msg, str):
+        _publish_event(robot_id, "telemetry", json_msg)
+    _send_telemetry(robot_id, msg, json_msg if packet else None)
+
+
+def _send_telemetry(robot_id, msg, json_msg=None, formats=TELEMETRY_FORMATS):
     dead = []
     with telemetry_lock:
-        for client in telemetry_clients.get(robot_id, set()):
+        for client, fmt in telemetry_clients.get(robot_id, {}).items():
+            if fmt not in formats:
+                continue
+            payload = json_msg if json_msg is not None and fmt == "json" else msg
             try:
-                client.send(msg)
+                client.send(payload)
             except Exception:
                 dead.append(client)
         for client in dead:
-            telemetry_clients.get(robot_id, set()).discard(client)
+            telemetry_clients.get(robot_id, {}).pop(client, None)
+
+
+def _get_event_log(key):
+    with event_logs_lock:
+        log = event_logs.get(key)
+        if log is None:
+            # Ids start at the current time in ms so that they keep increasing
+            # across server restarts and a stale Last-Event-ID never skips events.
+            log = {
+                "events": deque(maxlen=SSE_BUFFER_SIZE),
+                "next_id": int(time.time() * 1000),
+                "cond": threading.Condition(),
+                "subscribers": 0,
+            }
+            event_logs[key] = log
+        return log
+
+
+def _publish_event(key, event, data):
+    log = _get_event_log(key)
+    with log["cond"]:
+        log["events"].append((log["next_id"], event, data))
+        log["next_id"] += 1
+        log["cond"].notify_all()
+
+
+def _events_after(log, last_id):
+    # Returns (events, gap); gap is True when events after last_id were
+    # already evicted from the ring buffer.
+    events = log["events"]
+    if not events:
+        # An empty log (new after a restart or a sweep) can only continue a
+        # client that had already seen everything up to next_id - 1.
+        return [], last_id != log["next_id"] - 1
+    first_id = events[0][0]
+    if last_id >= log["next_id"] or last_id < first_id - 1:
+        return list(events), True
+    return [e for e in events if e[0] > last_id], False
+
+
+def _format_sse(event_id, event, data):
+    lines = [f"id: {event_id}", f"event: {event}"]
+    lines += [f"data: {line}" for line in str(data).splitlines() or [""]]
+    return "\n".join(lines) + "\n\n"
+
+
+def _sse_stream(key, last_id, snapshot):
+    log = _get_event_log(key)
+    with log["cond"]:
+        log["subscribers"] += 1
+    try:
+        yield from _sse_events(log, last_id, snapshot)
+    finally:
+        with log["cond"]:
+            log["subscribers"] -= 1
+
+
+def _sse_events(log, last_id, snapshot):
+    yield f"retry: {SSE_RETRY_MS}\n\n"
+    if last_id is None:
+        with log["cond"]:
+            last_id = log["next_id"] - 1
+        yield _format_sse(last_id, "snapshot", json.dumps(snapshot()))
+    while True:
+        with log["cond"]:
+            events, gap = _events_after(log, last_id)
+            if not events and not gap:
+                log["cond"].wait(SSE_KEEPALIVE_SECONDS)
+                events, gap = _events_after(log, last_id)
+        if gap:
+            # Events after last_id were evicted; hand the client fresh state,
+            # then whatever is still buffered.
+            if events:
+                last_id = events[0][0] - 1
+            else:
+                with log["cond"]:
+                    last_id = log["next_id"] - 1
+            yield _format_sse(last_id, "snapshot", json.dumps(snapshot()))
+        if not events:
+            yield ": keepalive\n\n"
+            continue
+        for event_id, event, data in events:
+            yield _format_sse(event_id, event, data)
+            last_id = event_id
+
+
+def _sse_response(key, snapshot):
+    # EventSource only sends Last-Event-ID on automatic reconnects, so a
+    # query parameter is accepted for manual resumes too.
+    raw_id = request.headers.get("Last-Event-ID") or request.args.get("last_event_id")
+    try:
+        last_id = int(raw_id) if raw_id else None
+    except ValueError:
+        last_id = None
+    return Response(
+        stream_with_context(_sse_stream(key, last_id, snapshot)),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def _publish_presence(robot_id, online, last_seen):
+    data = json.dumps({"uuid": robot_id, "online": online, "last_seen": last_seen})
+    _publish_event(robot_id, "presence", data)
+    _publish_event(PRESENCE_LOG, "presence", data)
+
+
+def _presence_watcher():
+    while True:
+        time.sleep(PRESENCE_CHECK_SECONDS)
+        went_offline = []
+        with robots_lock:
+            for rid, info in robots.items():
+                if info.get("announced_online") and not _is_online(info):
+                    info["announced_online"] = False
+                    went_offline.append((rid, info.get("last_seen")))
+        for rid, last_seen in went_offline:
+            _publish_presence(rid, False, last_seen)
+
+
+def _robot_snapshot(robot_id=None):
+    with robots_lock:
+        if robot_id is not None:
+            items = [(robot_id, robots.get(robot_id, {}))]
+        else:
+            items = list(robots.items())
+        return [
+            {
+                "uuid": rid,
+                "type": info.get("type"),
+                "last_seen": info.get("last_seen"),
+                "online": _is_online(info),
+            }
+            for rid, info in items
+        ]
+
+
+def _cached_prediction(robot_id, data):
+    # Results are keyed by frame content, so every operator asking about the
+    # same frame shares one upstream call. Returns (payload, cache status).
+    key = (robot_id, hashlib.blake2b(data, digest_size=16).hexdigest())
+    now = time.time()
+    with predict_lock:
+        entry = predict_cache.get(key)
+        if entry is not None and now - entry[0] <= PREDICT_CACHE_TTL_SECONDS:
+            predict_cache.move_to_end(key)
+            predict_stats["hits"] += 1
+            return entry[1], "hit"
+        inflight = predict_inflight.get(key)
+        if inflight is None:
+            inflight = predict_inflight[key] = {"done": threading.Event()}
+            owner = True
+            predict_stats["misses"] += 1
+        else:
+            owner = False
+            predict_stats["coalesced"] += 1
+    if not owner:
+        inflight["done"].wait(MODEL_API_TIMEOUT_SECONDS)
+        if "result" not in inflight:
+            raise RuntimeError(inflight.get("error", "timed out waiting for model"))
+        return inflight["result"], "coalesced"
+
+    started = time.monotonic()
+    try:
+        result = _call_model(data)
+    except Exception as e:
+        inflight["error"] = str(e)
+        raise
+    else:
+        inflight["result"] = result
+    finally:
+        elapsed_ms = (time.monotonic() - started) * 1000
+        with predict_lock:
+            predict_stats["upstream_calls"] += 1
+            predict_stats["upstream_ms_total"] += elapsed_ms
+            predict_stats["upstream_ms_max"] = max(predict_stats["upstream_ms_max"], elapsed_ms)
+            predict_stats["upstream_ms_last"] = elapsed_ms
+            if "result" in inflight:
+                predict_cache[key] = (time.time(), inflight["result"])
+                predict_cache.move_to_end(key)
+                while len(predict_cache) > PREDICT_CACHE_SIZE:
+                    predict_cache.popitem(last=False)
+            else:
+                predict_stats["upstream_errors"] += 1
+            del predict_inflight[key]
+        inflight["done"].set()
+    return result, "miss"
+
+
+def _call_model(data):
+    if MODEL_API_URL == "local":
+        return _local_model(data)
+    boundary = uuid.uuid4().hex
+    body = (
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="{MODEL_IMAGE_FIELD}"; filename="capture.jpg"\r\n'
+        "Content-Type: image/jpeg\r\n\r\n"
+    ).encode() + data + f"\r\n--{boundary}--\r\n".encode()
+    req = urllib.request.Request(
+        MODEL_API_URL,
+        data=body,
+        headers={"Content-Type": f"multipart/form-data; boundary={boundary}"},
+        method="POST",
+    )
+    with urllib.request.urlopen(req, timeout=MODEL_API_TIMEOUT_SECONDS) as resp:
+        text = resp.read().decode("utf-8", "replace")
+    try:
+        return json.loads(text)
+    except ValueError:
+        return {"raw": text}
+
+
+def _local_model(data):
+    # Deterministic stand-in for local runs and load tests.
+    time.sleep(0.2)
+    digest = hashlib.blake2b(data, digest_size=4).digest()
+    labels = ["Healthy", "Leaf Spot", "Rust", "Blight"]
+    scores = [b + 1 for b in digest]
+    total = sum(scores)
+    confidences = {label: score / total for label, score in zip(labels, scores)}
+    label = max(confidences, key=confidences.get)
+    return {
+        "predicted_label": label,
+        "confidence": confidences[label],
+        "all_confidences": confidences,
+    }
+
+
+def _ingest_allowed(robot_id, size):
+    now = time.monotonic()
+    with ingest_lock:
+        bucket = ingest_buckets.get(robot_id)
+        if bucket is None:
+            bucket = ingest_buckets[robot_id] = {"bytes": INGEST_BURST_BYTES, "updated": now}
+        elapsed = now - bucket["updated"]
+        bucket["updated"] = now
+        bucket["bytes"] = min(INGEST_BURST_BYTES, bucket["bytes"] + elapsed * INGEST_BYTES_PER_SEC)
+        if bucket["bytes"] < size:
+            return False
+        bucket["bytes"] -= size
+        return True
+
+
+def _begin_control():
+    global control_inflight
+    with control_lock:
+        control_inflight += 1
+        control_idle.clear()
+
+
+def _end_control():
+    global control_inflight
+    with control_lock:
+        control_inflight -= 1
+        if control_inflight == 0:
+            control_idle.set()
+
+
+def _wait_for_control():
+    # Bounded so a steady stream of control messages cannot starve video.
+    control_idle.wait(CONTROL_PRIORITY_WAIT_SECONDS)
+
+
+def _shard_for(robot_id):
+    if not SHARD_URLS:
+        return SHARD_INDEX
+    return zlib.crc32(robot_id.encode("utf-8")) % len(SHARD_URLS)
+
+
+def _is_unchanged_marker(msg):
+    if '"unchanged"' not in msg:
+        return False
+    try:
+        return json.loads(msg).get("type") == "unchanged"
+    except Exception:
+        return False
+
+
+def _count_video(robot_id, key):
+    with video_stats_lock:
+        counts = video_stats.get(robot_id)
+        if counts is None:
+            counts = video_stats[robot_id] = {
+                "frames": 0,
+                "duplicates": 0,
+                "unchanged_markers": 0,
+                "throttled": 0,
+                "fanout_skipped": 0,
+            }
+        counts[key] += 1
+
+
+def _reply_clock_sync(ws, msg):
+    # Answers {"type": "clock_sync", "t0": ...} so the peer can estimate its
+    # offset to the server clock from the round trip.
+    if not isinstance(msg, str) or '"clock_sync"' not in msg:
+        return False
+    try:
+        payload = json.loads(msg)
+    except ValueError:
+        return False
+    if not isinstance(payload, dict) or payload.get("type") != "clock_sync":
+        return False
+    reply = {"type": "clock_sync", "t0": payload.get("t0"), "server_time": time.time()}
+    try:
+        ws.send(json.dumps(reply))
+    except Exception:
+        pass
+    return True
+
+
+def _parse_trace(msg):
+    try:
+        payload = json.loads(msg)
+        trace = {
+            "id": next(trace_ids),
+            "capture": float(payload["capture"]),
+            "encoded": float(payload["encoded"]),
+            "clock_offset": payload.get("clock_offset"),
+            "clock_rtt": payload.get("clock_rtt"),
+        }
+    except Exception:
+        return None
+    # Without a clock_sync round trip the robot's timestamps are not on the
+    # server clock and would skew every stage.
+    if payload.get("type") != "trace" or trace["clock_rtt"] is None:
+        return None
+    return trace
+
+
+def _latency_state(robot_id):
+    state = latency_traces.get(robot_id)
+    if state is None:
+        state = latency_traces[robot_id] = {
+            "frames": deque(maxlen=TRACE_HISTORY),
+            "displays": deque(maxlen=TRACE_HISTORY),
+            "pending": OrderedDict(),
+            "clock": {},
+        }
+    return state
+
+
+def _record_frame_trace(robot_id, trace):
+    with latency_lock:
+        state = _latency_state(robot_id)
+        state["frames"].append(trace)
+        state["clock"] = {"offset": trace["clock_offset"], "rtt": trace["clock_rtt"]}
+        state["pending"][trace["id"]] = trace
+        while len(state["pending"]) > TRACE_PENDING:
+            state["pending"].popitem(last=False)
+
+
+def _handle_viewer_trace_message(ws, robot_id, msg):
+    if _reply_clock_sync(ws, msg):
+        return
+    try:
+        payload = json.loads(msg)
+        if payload.get("type") != "trace_display":
+            return
+        trace_id = int(payload["id"])
+        displayed = float(payload["displayed"])
+    except Exception:
+        return
+    with latency_lock:
+        state = latency_traces.get(robot_id)
+        trace = state["pending"].get(trace_id) if state else None
+        if trace is not None:
+            state["displays"].append(dict(trace, displayed=displayed))
+
+
+def _summarize_ms(values):
+    if not values:
+        return {"count": 0}
+    ordered = sorted(values)
+
+    def pick(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 1)
+
+    return {
+        "count": len(ordered),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 1),
+        "p50_ms": pick(0.5),
+        "p90_ms": pick(0.9),
+        "max_ms": round(ordered[-1] * 1000, 1),
+    }
+
+
+def _oversized_frame(robot_id, data):
+    if len(data) <= MAX_FRAME_BYTES:
+        return False
+    with memory_stats_lock:
+        memory_stats["oversized_frames"] += 1
+        first = memory_stats["oversized_frames"] == 1
+    if first:
+        print(f"[mem] dropping frames over {MAX_FRAME_BYTES} bytes (first from {robot_id})")
+    return True
+
+
+def _segment_bytes(state):
+    size = sum(len(seg["body"]) for seg in state["closed"])
+    if state["open"] is not None:
+        size += state["open"]["bytes"]
+    return size
+
+
+def _retained_bytes_by_robot():
+    usage = {}
+
+    def add(robot_id, kind, size):
+        entry = usage.setdefault(robot_id, {"frames": 0, "thermal": 0, "segments": 0})
+        entry[kind] += size
+
+    with latest_frames_lock:
+        for rid, data in latest_frames.items():
+            add(rid, "frames", len(data))
+    with latest_thermal_lock:
+        for rid, data in latest_thermal_frames.items():
+            add(rid, "thermal", len(data))
+    with segments_lock:
+        for rid, state in segments.items():
+            add(rid, "segments", _segment_bytes(state))
+    return usage
+
+
+def _forget_robot(robot_id):
+    with robots_lock:
+        robots.pop(robot_id, None)
+    with latest_frames_lock:
+        latest_frames.pop(robot_id, None)
+        latest_frame_seq.pop(robot_id, None)
+        latest_frame_hash.pop(robot_id, None)
+    with video_stats_lock:
+        video_stats.pop(robot_id, None)
+    with latest_thermal_lock:
+        latest_thermal_frames.pop(robot_id, None)
+        latest_thermal_seq.pop(robot_id, None)
+    with segments_lock:
+        segments.pop(robot_id, None)
+    with latency_lock:
+        latency_traces.pop(robot_id, None)
+    with ingest_lock:
+        ingest_buckets.pop(robot_id, None)
+    with predict_lock:
+        for key in [key for key in predict_cache if key[0] == robot_id]:
+            del predict_cache[key]
+    with event_logs_lock:
+        log = event_logs.get(robot_id)
+        # A connected SSE client keeps waiting on this log object, so it
+        # stays until the last subscriber leaves.
+        if log is not None and log["subscribers"] == 0:
+            del event_logs[robot_id]
+
+
+def _drop_empty_client_sets():
+    for clients, lock in (
+        (video_clients, video_clients_lock),
+        (thermal_clients, thermal_clients_lock),
+        (command_clients, command_lock),
+        (telemetry_clients, telemetry_lock),
+    ):
+        with lock:
+            for rid in [rid for rid, members in clients.items() if not members]:
+                del clients[rid]
+
+
+def _enforce_memory_budget():
+    # Segments are a replay cache and go first; latest frames follow. Within
+    # each pass the robots that were seen longest ago are evicted first.
+    usage = _retained_bytes_by_robot()
+    total = sum(sum(entry.values()) for entry in usage.values())
+    if total <= FRAME_MEMORY_BUDGET_BYTES:
+        return
+    with robots_lock:
+        last_seen = {rid: info.get("last_seen") or 0 for rid, info in robots.items()}
+    order = sorted(usage, key=lambda rid: last_seen.get(rid, 0))
+    evictions = 0
+    for kinds in (("segments",), ("frames", "thermal")):
+        for rid in order:
+            if total <= FRAME_MEMORY_BUDGET_BYTES:
+                break
+            freed = sum(usage[rid][kind] for kind in kinds)
+            if not freed:
+                continue
+            if "segments" in kinds:
+                with segments_lock:
+                    segments.pop(rid, None)
+            else:
+                with latest_frames_lock:
+                    latest_frames.pop(rid, None)
+                    latest_frame_hash.pop(rid, None)
+                with latest_thermal_lock:
+                    latest_thermal_frames.pop(rid, None)
+            for kind in kinds:
+                usage[rid][kind] = 0
+            total -= freed
+            evictions += 1
+    with memory_stats_lock:
+        memory_stats["budget_evictions"] += evictions
+    print(f"[mem] over budget; evicted {evictions} entries, {total} bytes retained")
+
+
+def _state_sweeper():
+    while True:
+        time.sleep(SWEEP_INTERVAL_SECONDS)
+        now = time.time()
+        with robots_lock:
+            known = dict(robots)
+        with latest_frames_lock:
+            candidates = set(latest_frames) | set(latest_frame_seq)
+        with latest_thermal_lock:
+            candidates |= set(latest_thermal_frames) | set(latest_thermal_seq)
+        with segments_lock:
+            candidates |= {
+                rid
+                for rid, state in segments.items()
+                if now - state["watched_at"] > ROBOT_STATE_TTL_SECONDS
+            }
+        with event_logs_lock:
+            # Includes ids that never registered and logs that outlived
+            # _forget_robot because a viewer was still subscribed then.
+            candidates |= {
+                key
+                for key, log in event_logs.items()
+                if key != PRESENCE_LOG and log["subscribers"] == 0
+            }
+        candidates |= set(known)
+        expired = [
+            rid
+            for rid in candidates
+            if now - (known.get(rid, {}).get("last_seen") or 0) > ROBOT_STATE_TTL_SECONDS
+        ]
+        for rid in expired:
+            _forget_robot(rid)
+        if expired:
+            with memory_stats_lock:
+                memory_stats["evicted_robots"] += len(expired)
+            print(f"[mem] evicted state for {len(expired)} offline robots")
+        _drop_empty_client_sets()
+        _enforce_memory_budget()
 
 
 def _touch_robot(robot_id, robot_type=None):
@@ -360,7 +1468,11 @@ def _touch_robot(robot_id, robot_type=None):
         if robot_type:
             info["type"] = robot_type
         info["last_seen"] = now
+        came_online = not info.get("announced_online")
+        info["announced_online"] = True
         robots[robot_id] = info
+    if came_online:
+        _publish_presence(robot_id, True, now)
 
 
 def _is_online(info):
@@ -370,6 +1482,10 @@ def _is_online(info):
     return (time.time() - last_seen) <= ONLINE_TTL_SECONDS
 
 
+threading.Thread(target=_presence_watcher, daemon=True).start()
+threading.Thread(target=_state_sweeper, daemon=True).start()
+
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
     app.run(host="0.0.0.0", port=port)
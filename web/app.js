@@ -27,9 +27,10 @@ const capturePreviewEl = document.getElementById("capturePreview");
 const SERVER_HTTP_BASE = "https://detectionbot12-colo.onrender.com";
 const ROBOT_UUID = "Agraid";
 const CLIENT_ID = "web-control";
-const MODEL_API_URL = "https://leaf-disease-api-v3fr.onrender.com/predict";
-const MODEL_API_TIMEOUT_MS = 30000;
-const MODEL_IMAGE_FIELD = "file";
+const PREDICT_TIMEOUT_MS = 35000;
+
+const CLOCK_SYNC_INTERVAL_MS = 5000;
+const CLOCK_SYNC_SAMPLES = 8;
 
 const ROBOT_OFFLINE_MS = 10000; // no frame/telemetry for this long = robot offline
 const ROBOT_OFFLINE_CHECK_MS = 2000;
@@ -37,6 +38,8 @@ const ROBOT_OFFLINE_CHECK_MS = 2000;
 let videoWs = null;
 let thermalWs = null;
 let commandWs = null;
+let robotEvents = null;
+let shardBase = null; // set when a sharded relay routes this robot elsewhere
 let firstFrameSeen = false;
 let lastLiveDataAt = 0;
 let robotOfflineCheckTimer = null;
@@ -44,6 +47,11 @@ let liveFrameCount = 0;
 let firstLiveFrameAt = 0;
 let lastVideoBuffer = null;
 let predictionInFlight = false;
+let clockSyncTimer = null;
+let clockSamples = [];
+let clockOffset = 0; // server time minus local time, seconds
+let nextTraceId = null; // trace announced for the next video frame
+let displayingTraceId = null; // trace of the frame currently loading
 const videoState = { pending: false, currentUrl: null };
 const thermalState = { pending: false, currentUrl: null };
 const pressedKeys = new Set();
@@ -148,7 +156,7 @@ async function blobFromImageElement(imgEl) {
   });
 }
 function getServerBase() {
-  return SERVER_HTTP_BASE.replace(/\/+$/, "");
+  return (shardBase || SERVER_HTTP_BASE).replace(/\/+$/, "");
 }
 
 function getWsBase() {
@@ -159,7 +167,7 @@ function getWsBase() {
 
 function updateImageFromBuffer(imgEl, buffer, state) {
   if (state.pending) {
-    return;
+    return false;
   }
   const blob = new Blob([buffer], { type: "image/jpeg" });
   const nextUrl = URL.createObjectURL(blob);
@@ -169,6 +177,7 @@ function updateImageFromBuffer(imgEl, buffer, state) {
     URL.revokeObjectURL(state.currentUrl);
   }
   state.currentUrl = nextUrl;
+  return true;
 }
 
 function resetImageState(imgEl, state) {
@@ -182,6 +191,59 @@ function resetImageState(imgEl, state) {
   }
 }
 
+function startClockSync(ws) {
+  stopClockSync();
+  const sync = () => {
+    if (ws.readyState === WebSocket.OPEN) {
+      ws.send(JSON.stringify({ type: "clock_sync", t0: Date.now() / 1000 }));
+    }
+  };
+  sync();
+  clockSyncTimer = setInterval(sync, CLOCK_SYNC_INTERVAL_MS);
+}
+
+function stopClockSync() {
+  if (clockSyncTimer) {
+    clearInterval(clockSyncTimer);
+    clockSyncTimer = null;
+  }
+  clockSamples = [];
+  nextTraceId = null;
+  displayingTraceId = null;
+}
+
+function handleVideoControlMessage(text) {
+  let payload = null;
+  try {
+    payload = JSON.parse(text);
+  } catch (e) {
+    return;
+  }
+  if (payload.type === "clock_sync") {
+    // Keep the offset from the lowest-RTT round trip.
+    const t1 = Date.now() / 1000;
+    clockSamples.push({ rtt: t1 - payload.t0, offset: payload.server_time - (payload.t0 + t1) / 2 });
+    clockSamples = clockSamples.slice(-CLOCK_SYNC_SAMPLES);
+    clockOffset = clockSamples.reduce((best, s) => (s.rtt < best.rtt ? s : best)).offset;
+  } else if (payload.type === "trace") {
+    nextTraceId = payload.id;
+  }
+}
+
+function reportTraceDisplayed() {
+  if (displayingTraceId === null || !videoWs || videoWs.readyState !== WebSocket.OPEN) {
+    return;
+  }
+  videoWs.send(
+    JSON.stringify({
+      type: "trace_display",
+      id: displayingTraceId,
+      displayed: Date.now() / 1000 + clockOffset,
+    })
+  );
+  displayingTraceId = null;
+}
+
 function setStatus(text) {
   statusEl.textContent = `Status: ${text}`;
 }
@@ -195,15 +257,53 @@ function checkRobotOffline() {
   const onlyOneStaleFrame = liveFrameCount === 1 && firstLiveFrameAt && (now - firstLiveFrameAt > ROBOT_OFFLINE_MS);
   const wasLiveThenStopped = lastLiveDataAt > 0 && (now - lastLiveDataAt > ROBOT_OFFLINE_MS);
   if (onlyOneStaleFrame || wasLiveThenStopped) {
-    setStatus("robot offline");
-    resetImageState(videoEl, videoState);
-    resetImageState(thermalEl, thermalState);
-    if (videoEl && useMjpegEl && useMjpegEl.checked) {
-      videoEl.src = "";
-    }
-    if (thermalEl && useMjpegThermalEl && useMjpegThermalEl.checked) {
-      thermalEl.src = "";
-    }
+    showRobotOffline();
+  }
+}
+
+function showRobotOffline() {
+  setStatus("robot offline");
+  resetImageState(videoEl, videoState);
+  resetImageState(thermalEl, thermalState);
+  if (videoEl && useMjpegEl && useMjpegEl.checked) {
+    videoEl.src = "";
+  }
+  if (thermalEl && useMjpegThermalEl && useMjpegThermalEl.checked) {
+    thermalEl.src = "";
+  }
+}
+
+function applyPresence(robotId, presence) {
+  if (!presence || presence.uuid !== robotId) return;
+  if (presence.online) {
+    setStatus(`robot online: ${robotId}`);
+  } else {
+    showRobotOffline();
+  }
+}
+
+function connectRobotEvents(robotId) {
+  closeRobotEvents();
+  if (!window.EventSource) return;
+  // EventSource reconnects on its own and resumes from Last-Event-ID.
+  robotEvents = new EventSource(
+    `${getServerBase()}/api/robots/${encodeURIComponent(robotId)}/events`
+  );
+  robotEvents.addEventListener("snapshot", (event) => {
+    applyPresence(robotId, JSON.parse(event.data));
+  });
+  robotEvents.addEventListener("presence", (event) => {
+    const presence = JSON.parse(event.data);
+    log(`robot ${presence.online ? "online" : "offline"}: ${robotId}`);
+    applyPresence(robotId, presence);
+  });
+  robotEvents.onerror = () => log("robot events reconnecting");
+}
+
+function closeRobotEvents() {
+  if (robotEvents) {
+    robotEvents.close();
+    robotEvents = null;
   }
 }
 
@@ -236,69 +336,51 @@ function formatNumber(value, digits = 2) {
 
 async function captureAndPredict() {
   if (predictionInFlight) return;
-  if (!MODEL_API_URL) {
-    setPredictionStatus("MODEL_API_URL not configured.");
-    return;
-  }
   predictionInFlight = true;
   if (captureFrameBtn) {
     captureFrameBtn.disabled = true;
   }
-  setPredictionStatus("Capturing frame...");
+  setPredictionStatus("Requesting prediction...");
   try {
-    if (useMjpegEl && useMjpegEl.checked && !lastVideoBuffer) {
-      setPredictionStatus("Capturing MJPEG frame (may require CORS).");
-    }
-    let blob = null;
-    if (lastVideoBuffer) {
-      blob = new Blob([lastVideoBuffer], { type: "image/jpeg" });
-    } else {
-      blob = await blobFromImageElement(videoEl);
-    }
-
+    // The server predicts on the frame it already holds; the local copy is
+    // only used for the preview.
     if (capturePreviewEl) {
-      const previewUrl = URL.createObjectURL(blob);
-      capturePreviewEl.src = previewUrl;
-      setTimeout(() => URL.revokeObjectURL(previewUrl), 30000);
+      try {
+        const blob = lastVideoBuffer
+          ? new Blob([lastVideoBuffer], { type: "image/jpeg" })
+          : await blobFromImageElement(videoEl);
+        const previewUrl = URL.createObjectURL(blob);
+        capturePreviewEl.src = previewUrl;
+        setTimeout(() => URL.revokeObjectURL(previewUrl), 30000);
+      } catch (e) {
+        log(`preview unavailable: ${e.message}`);
+      }
     }
 
-    setPredictionStatus("Sending to model...");
     const controller = new AbortController();
-    const timeoutId = setTimeout(() => controller.abort(), MODEL_API_TIMEOUT_MS);
-    const formData = new FormData();
-    formData.append(MODEL_IMAGE_FIELD, blob, "capture.jpg");
-
-    const response = await fetch(MODEL_API_URL, {
-      method: "POST",
-      body: formData,
-      signal: controller.signal,
-    });
+    const timeoutId = setTimeout(() => controller.abort(), PREDICT_TIMEOUT_MS);
+    const response = await fetch(
+      `${getServerBase()}/api/robots/${encodeURIComponent(ROBOT_UUID)}/predict`,
+      { method: "POST", signal: controller.signal }
+    );
     clearTimeout(timeoutId);
 
+    const result = await response.json().catch(() => ({}));
     if (!response.ok) {
-      const errText = await response.text();
-      throw new Error(`Model error (${response.status}): ${errText}`);
-    }
-    let payload = null;
-    const text = await response.text();
-    try {
-      payload = JSON.parse(text);
-    } catch (e) {
-      payload = { raw: text };
+      throw new Error(result.error || `Prediction error (${response.status})`);
     }
+    const payload = result.prediction || {};
 
     const { label, confidence } = extractPrediction(payload);
     if (predictionLabelEl) predictionLabelEl.textContent = label;
     if (predictionConfidenceEl) predictionConfidenceEl.textContent = formatConfidence(confidence);
     renderAllConfidences(payload.all_confidences);
-    setPredictionStatus("Prediction complete.");
+    setPredictionStatus(
+      `Prediction complete (frame ${result.frame_seq}${result.cache === "miss" ? "" : ", cached"}).`
+    );
   } catch (err) {
     const message = err && err.message ? err.message : "Prediction failed";
-    if (useMjpegEl && useMjpegEl.checked && !lastVideoBuffer) {
-      setPredictionStatus("Capture failed. MJPEG may be blocked by CORS; switch to WebSocket and try again.");
-    } else {
-      setPredictionStatus(message);
-    }
+    setPredictionStatus(message);
     if (predictionListEl) predictionListEl.textContent = "--";
   } finally {
     predictionInFlight = false;
@@ -308,6 +390,26 @@ async function captureAndPredict() {
   }
 }
 
+async function resolveShard(robotId) {
+  shardBase = null;
+  try {
+    const base = SERVER_HTTP_BASE.replace(/\/+$/, "");
+    const res = await fetch(`${base}/api/robots/${encodeURIComponent(robotId)}/shard`);
+    const shard = await res.json();
+    if (shard.url) {
+      shardBase = shard.url;
+      log(`robot served by shard ${shard.url}`);
+    }
+  } catch (e) {
+    log("shard lookup failed; using default server");
+  }
+}
+
+async function connectRobot(robotId) {
+  await resolveShard(robotId);
+  connectSockets(robotId);
+}
+
 function connectSockets(robotId) {
   disconnectSockets();
   liveFrameCount = 0;
@@ -320,6 +422,7 @@ function connectSockets(robotId) {
     setStatus("server url required");
     return;
   }
+  connectRobotEvents(robotId);
   const useMjpeg = useMjpegEl && useMjpegEl.checked;
   if (useMjpeg) {
     const httpBase = getServerBase();
@@ -334,6 +437,10 @@ function connectSockets(robotId) {
     videoWs = new WebSocket(`${wsBase}/ws/video/client/${robotId}`);
     videoWs.binaryType = "arraybuffer";
     videoWs.onmessage = (event) => {
+      if (typeof event.data === "string") {
+        handleVideoControlMessage(event.data);
+        return;
+      }
       liveFrameCount++;
       lastVideoBuffer = event.data;
       if (liveFrameCount === 1) {
@@ -342,14 +449,20 @@ function connectSockets(robotId) {
         markLive();
         setStatus(`connected: ${robotId}`);
       }
-      updateImageFromBuffer(videoEl, event.data, videoState);
+      const shown = updateImageFromBuffer(videoEl, event.data, videoState);
+      if (shown && nextTraceId !== null) {
+        displayingTraceId = nextTraceId;
+      }
+      nextTraceId = null;
     };
     videoWs.onopen = () => {
+      startClockSync(videoWs);
       setStatus(`waiting for robot: ${robotId}`);
       startRobotOfflineChecker();
       log("video socket connected");
     };
     videoWs.onclose = () => {
+      stopClockSync();
       stopRobotOfflineChecker();
       setStatus("disconnected");
       log("video socket disconnected");
@@ -405,6 +518,8 @@ function connectSockets(robotId) {
 
 function disconnectSockets() {
   stopRobotOfflineChecker();
+  stopClockSync();
+  closeRobotEvents();
   [videoWs, thermalWs, commandWs].forEach((ws) => {
     if (ws && ws.readyState <= 1) {
       ws.close();
@@ -464,7 +579,7 @@ function sendCommand() {
 }
 
 connectBtn.addEventListener("click", () => {
-  connectSockets(ROBOT_UUID);
+  connectRobot(ROBOT_UUID);
 });
 disconnectBtn.addEventListener("click", disconnectSockets);
 sendCommandBtn.addEventListener("click", sendCommand);
@@ -518,12 +633,13 @@ if (speedDial && speedValue) {
   });
 }
 log("ui ready");
-connectSockets(ROBOT_UUID);
+connectRobot(ROBOT_UUID);
 
 videoEl.addEventListener("load", () => {
   if (videoState.pending) {
     videoState.pending = false;
   }
+  reportTraceDisplayed();
   if (!firstFrameSeen) {
     firstFrameSeen = true;
     log("live started: first video frame received");